@@ -21,7 +21,12 @@ Seaborn is used for optional styling.**bold text**
 
 # import statements
 
-from google.colab import files
+try:
+    from google.colab import files
+except ImportError:
+    # running outside Colab - profiles can be read from an archive instead
+    # (see "Reading profiles from a zip or tar archive" below)
+    files = None
 import matplotlib.pyplot as plt
 import numpy as np
 import io
@@ -36,14 +41,16 @@ mpl.rc_file_defaults()
 
 """## Upload profiles
 
-Run the following cell to launch the file upload dialogue.
+Run the following cell to launch the file upload dialogue. Outside Colab there is no dialogue and `uploaded` is left empty, so read your profiles from an archive instead (see "Reading profiles from a zip or tar archive").
 
 If you have already uploaded some files, re-uploading files with the same names will lead to filenames such as "Profile_1 (1).txt" which will then effect the later filename parsing.
 
 If you want to re-upload files, please select "Disconnect and delete runtime" from the "Runtime" menu to avoid this naming issue.
 """
 
-uploaded = files.upload()
+# outside Colab there is no upload dialogue: read an archive instead
+# (see "Reading profiles from a zip or tar archive" below)
+uploaded = files.upload() if files is not None else {}
 
 """The above dialogue should show you a list of correctly uploaded files. Note that these files are not stored persistently - you should keep a copy on your machine and re-upload when you use this script.
 
@@ -1141,3 +1148,2555 @@ if save_figure:
     plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
 plt.show()
 
+"""# Working with large datasets
+
+The cells above re-read every uploaded file for each plot, which is fine for a handful of profiles. The sections below are for larger studies (hundreds or thousands of adjacent profiles). Each section first defines some functions, then has an example cell that you can modify.
+
+## Extracting profiles directly from a DEM
+
+Rather than exporting each profile by hand, you can sample them straight from the DEM (for example a MOLA or HRSC mosaic).
+
+Large DEMs are read in square tiles. The most recently used tiles are kept in memory (a "least recently used" or LRU cache), so neighbouring transects don't read the same blocks from disk over and over. The points along the transects are looked up in large batches, grouped by tile, so each tile is visited once per batch.
+
+The DEM can be a `.npy` array (which is memory-mapped, so only the tiles you need are read) or, if [rasterio](https://rasterio.readthedocs.io) is installed, a GeoTIFF or any other raster GDAL can read.
+"""
+
+import os
+from collections import OrderedDict
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+
+class TiledDEM:
+    # Read-only access to a DEM in square tiles, with an LRU cache of decoded tiles.
+    #
+    # read_window(row0, row1, col0, col1) must return the 2D block of elevations
+    # for those pixel rows and columns. transform is (x_origin, pixel_width,
+    # y_origin, pixel_height) in metres, i.e. a GDAL geotransform without rotation;
+    # pixel_height is negative for north-up rasters.
+
+    def __init__(self, read_window, shape, transform, tile_size=512, max_tiles=64, nodata=None):
+        self.read_window = read_window
+        self.shape = shape
+        self.transform = transform
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.nodata = nodata
+
+        # number of tiles along each axis (the last row/column of tiles may be smaller)
+        self.n_tile_rows = -(-shape[0] // tile_size)
+        self.n_tile_cols = -(-shape[1] // tile_size)
+
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_file(cls, path, transform=None, **kwargs):
+        if path.endswith(".npy"):
+            # a plain array has no georeferencing, so the transform must be given
+            if transform is None:
+                raise ValueError("transform is required for .npy DEMs")
+            array = np.load(path, mmap_mode='r')
+            return cls(lambda r0, r1, c0, c1: array[r0:r1, c0:c1], array.shape, transform, **kwargs)
+
+        if rasterio is None:
+            raise ImportError("rasterio is needed to read " + path + " (or convert the DEM to .npy)")
+        src = rasterio.open(path)
+        if transform is None:
+            transform = (src.transform.c, src.transform.a, src.transform.f, src.transform.e)
+        kwargs.setdefault("nodata", src.nodata)
+
+        def read_window(r0, r1, c0, c1):
+            return src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+        return cls(read_window, (src.height, src.width), transform, **kwargs)
+
+    def _tile(self, tile_id):
+        # return a decoded tile, reading it from disk only if it isn't cached
+        tile = self._cache.get(tile_id)
+        if tile is not None:
+            self.hits += 1
+            self._cache.move_to_end(tile_id)
+            return tile
+
+        self.misses += 1
+        ty, tx = divmod(tile_id, self.n_tile_cols)
+        r0 = ty * self.tile_size
+        c0 = tx * self.tile_size
+        r1 = min(r0 + self.tile_size, self.shape[0])
+        c1 = min(c0 + self.tile_size, self.shape[1])
+        tile = np.array(self.read_window(r0, r1, c0, c1), dtype=float)
+        if self.nodata is not None:
+            tile[tile == self.nodata] = np.nan
+
+        self._cache[tile_id] = tile
+        if len(self._cache) > self.max_tiles:
+            # drop the least recently used tile
+            self._cache.popitem(last=False)
+        return tile
+
+    def lookup(self, rows, cols):
+        # elevations at integer pixel positions, visiting each tile once per call
+        shape = np.shape(rows)
+        rows = np.asarray(rows, dtype=np.int64).ravel()
+        cols = np.asarray(cols, dtype=np.int64).ravel()
+        values = np.full(rows.shape, np.nan)
+
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        idx = np.flatnonzero(inside)
+        if len(idx) == 0:
+            return values.reshape(shape)
+        tile_ids = (rows[idx] // self.tile_size) * self.n_tile_cols + cols[idx] // self.tile_size
+
+        # sort the points by tile so each tile is a contiguous run
+        order = np.argsort(tile_ids, kind='stable')
+        idx = idx[order]
+        tile_ids = tile_ids[order]
+        starts = np.flatnonzero(np.r_[True, tile_ids[1:] != tile_ids[:-1]])
+        ends = np.r_[starts[1:], len(idx)]
+
+        for start, end in zip(starts, ends):
+            tile = self._tile(tile_ids[start])
+            run = idx[start:end]
+            values[run] = tile[rows[run] % self.tile_size, cols[run] % self.tile_size]
+        return values.reshape(shape)
+
+    def sample(self, x, y):
+        # bilinear interpolation of the elevation at map coordinates x, y
+        x0, dx, y0, dy = self.transform
+        col = (np.asarray(x, dtype=float) - x0) / dx - 0.5
+        row = (np.asarray(y, dtype=float) - y0) / dy - 0.5
+
+        c0 = np.clip(np.floor(col), 0, self.shape[1] - 2).astype(np.int64)
+        r0 = np.clip(np.floor(row), 0, self.shape[0] - 2).astype(np.int64)
+        fc = np.clip(col - c0, 0, 1)
+        fr = np.clip(row - r0, 0, 1)
+
+        # look up all four neighbours in one batch so each tile is read once
+        corners = self.lookup(np.concatenate([r0, r0, r0 + 1, r0 + 1]),
+                              np.concatenate([c0, c0 + 1, c0, c0 + 1])).reshape(4, *c0.shape)
+        z = ((1 - fr) * ((1 - fc) * corners[0] + fc * corners[1])
+             + fr * ((1 - fc) * corners[2] + fc * corners[3]))
+
+        # points outside the DEM have no elevation
+        outside = (col < -0.5) | (col > self.shape[1] - 0.5) | (row < -0.5) | (row > self.shape[0] - 0.5)
+        z[outside] = np.nan
+        return z
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "cached_tiles": len(self._cache), "max_tiles": self.max_tiles}
+
+
+def extract_profiles(dem, transects, spacing, batch_size=1000):
+    # sample every transect at a fixed spacing [m] along its length
+    # transects is a dictionary of {profile name: ((x_start, y_start), (x_end, y_end))}
+    # returns a dictionary of {profile name: (distance along profile, elevation)}
+    names = list(transects)
+    profiles = {}
+
+    # transects are looked up batch_size at a time; tiles stay cached between batches
+    for b in range(0, len(names), batch_size):
+        batch = names[b:b + batch_size]
+        distances = []
+        points_x = []
+        points_y = []
+        for name in batch:
+            (xs, ys), (xe, ye) = transects[name]
+            length = np.hypot(xe - xs, ye - ys)
+            if length == 0:
+                raise ValueError("transect " + str(name) + " has the same start and end point")
+            d = np.arange(int(length // spacing) + 1) * spacing
+            distances.append(d)
+            points_x.append(xs + (xe - xs) * d / length)
+            points_y.append(ys + (ye - ys) * d / length)
+
+        z = dem.sample(np.concatenate(points_x), np.concatenate(points_y))
+        z = np.split(z, np.cumsum([len(d) for d in distances])[:-1])
+        profiles.update(zip(batch, zip(distances, z)))
+    return profiles
+
+
+def profile_to_bytes(x, y):
+    # write a profile in the same tab-separated format as the exported profile files
+    buffer = io.BytesIO()
+    np.savetxt(buffer, np.column_stack([x, y]), delimiter='\t', header='x\ty', comments='')
+    return buffer.getvalue()
+
+"""Set `dem_path` to your DEM, and list the start and end point of each transect in map coordinates (metres). For a `.npy` DEM you also need to give `dem_transform`: the x and y of the top left corner and the pixel width and height (negative if north is up).
+
+The extracted profiles are stored in `dem_profiles`, in the same format as the uploaded files. Set `use_dem_profiles = True` to replace the `uploaded` dictionary with them, so you can then re-run the plotting cells above on the extracted profiles. The cell is skipped if there is no file at `dem_path`.
+"""
+
+dem_path = "dem.npy"
+use_dem_profiles = False  # True to replace the uploaded profiles with the extracted ones
+dem_transform = (0.0, 200.0, 0.0, -200.0)  # only needed for .npy files
+
+# sampling distance along each profile [m]
+profile_spacing = 200
+
+# {profile name: ((x_start, y_start), (x_end, y_end))}
+transects = {
+    "Profile_01.txt": ((10000, -20000), (19000, -20000)),
+    "Profile_02.txt": ((10000, -21000), (19000, -21000)),
+    "Profile_03.txt": ((10000, -22000), (19000, -22000)),
+}
+
+if os.path.exists(dem_path):
+    dem = TiledDEM.from_file(dem_path, transform=dem_transform, tile_size=512, max_tiles=64)
+    extracted = extract_profiles(dem, transects, profile_spacing)
+
+    # store the profiles in the same format as the uploaded files
+    dem_profiles = {name: profile_to_bytes(x, y) for name, (x, y) in extracted.items()}
+    if use_dem_profiles:
+        uploaded = dem_profiles
+
+    print(sorted(dem_profiles.keys()))
+    print(dem.cache_info())
+else:
+    print("No DEM found at", dem_path, "- skipping this example")
+
+"""### Quick low-resolution profiles from an overview pyramid
+
+For a first look over a whole region you often don't need full-resolution profiles. An overview pyramid is a set of copies of the DEM, each at half the resolution of the one before (each pixel is the mean of a 2x2 block of the level below). The pyramid is built once and saved to a directory as `.npy` files.
+
+When sampling, the coarsest level whose pixels are still no larger than the requested profile spacing is used, so a profile with 2 km spacing on a 200 m DEM is read from the 1.6 km level, touching about 64 times fewer pixels.
+"""
+
+import json
+
+
+class DEMPyramid:
+    # A DEM plus its overviews; levels[0] is the full-resolution DEM and each
+    # following level has half the resolution of the one before.
+
+    def __init__(self, levels):
+        self.levels = levels
+
+    @classmethod
+    def build(cls, dem, directory, min_size=128, rows_per_strip=1024, **kwargs):
+        # write overview levels of a TiledDEM into directory until the
+        # smallest side would drop below min_size pixels
+        os.makedirs(directory, exist_ok=True)
+        metadata = {"levels": []}
+        levels = [dem]
+
+        source = dem
+        while min(source.shape) // 2 >= min_size:
+            level = len(levels)
+            shape = (-(-source.shape[0] // 2), -(-source.shape[1] // 2))
+            x0, dx, y0, dy = source.transform
+            transform = (x0, dx * 2, y0, dy * 2)
+            file_name = "level_" + str(level) + ".npy"
+            out = np.lib.format.open_memmap(os.path.join(directory, file_name), mode='w+',
+                                            dtype=np.float32, shape=shape)
+
+            # average 2x2 blocks, a strip of rows at a time to keep memory bounded
+            for r0 in range(0, source.shape[0], 2 * rows_per_strip):
+                r1 = min(r0 + 2 * rows_per_strip, source.shape[0])
+                block = np.array(source.read_window(r0, r1, 0, source.shape[1]), dtype=float)
+                if source.nodata is not None:
+                    block[block == source.nodata] = np.nan
+
+                # pad odd edges with NaN so every output pixel has a full 2x2 block
+                padded = np.full((-(-block.shape[0] // 2) * 2, shape[1] * 2), np.nan)
+                padded[:block.shape[0], :block.shape[1]] = block
+                blocks = padded.reshape(padded.shape[0] // 2, 2, shape[1], 2)
+
+                # mean of the valid pixels in each block (NaN if there are none)
+                valid = ~np.isnan(blocks)
+                total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+                count = valid.sum(axis=(1, 3))
+                with np.errstate(invalid='ignore'):
+                    out[r0 // 2:r0 // 2 + total.shape[0]] = total / count
+            out.flush()
+            del out
+
+            metadata["levels"].append({"file": file_name, "transform": transform})
+            source = TiledDEM.from_file(os.path.join(directory, file_name), transform=transform, **kwargs)
+            levels.append(source)
+
+        with open(os.path.join(directory, "pyramid.json"), "w") as f:
+            json.dump(metadata, f, indent=2)
+        return cls(levels)
+
+    @classmethod
+    def open(cls, dem, directory, **kwargs):
+        # reopen a pyramid written by DEMPyramid.build
+        with open(os.path.join(directory, "pyramid.json")) as f:
+            metadata = json.load(f)
+        levels = [dem]
+        for entry in metadata["levels"]:
+            levels.append(TiledDEM.from_file(os.path.join(directory, entry["file"]),
+                                             transform=tuple(entry["transform"]), **kwargs))
+        return cls(levels)
+
+    def pixel_size(self, level):
+        return abs(self.levels[level].transform[1])
+
+    def level_for_spacing(self, spacing):
+        # the coarsest level whose pixels are no larger than the profile spacing
+        best = 0
+        for level in range(len(self.levels)):
+            if self.pixel_size(level) <= spacing:
+                best = level
+        return best
+
+    def extract_profiles(self, transects, spacing, **kwargs):
+        dem = self.levels[self.level_for_spacing(spacing)]
+        return extract_profiles(dem, transects, spacing, **kwargs)
+
+"""The first time this is run the pyramid is written to `pyramid_directory`; after that it is just reopened. If you change the DEM, delete the directory so the pyramid is rebuilt.
+
+As above, the profiles are stored in `pyramid_profiles`, and only replace `uploaded` if you set `use_pyramid_profiles = True`.
+"""
+
+pyramid_directory = "dem_pyramid"
+use_pyramid_profiles = False  # True to replace the uploaded profiles with these
+
+# exploratory sampling distance along each profile [m]
+profile_spacing = 1000
+
+# the pyramid is built from the DEM opened in the cell above
+if os.path.exists(dem_path):
+    if os.path.exists(os.path.join(pyramid_directory, "pyramid.json")):
+        pyramid = DEMPyramid.open(dem, pyramid_directory)
+    else:
+        pyramid = DEMPyramid.build(dem, pyramid_directory)
+
+    level = pyramid.level_for_spacing(profile_spacing)
+    print("Using level", level, "with", pyramid.pixel_size(level), "m pixels")
+
+    extracted = pyramid.extract_profiles(transects, profile_spacing)
+    pyramid_profiles = {name: profile_to_bytes(x, y) for name, (x, y) in extracted.items()}
+    if use_pyramid_profiles:
+        uploaded = pyramid_profiles
+
+    print(sorted(pyramid_profiles.keys()))
+else:
+    print("No DEM found at", dem_path, "- skipping this example")
+
+"""## Reading profiles from a zip or tar archive
+
+If your profiles come as an archive of many `Profile_N.txt` files, you don't need to extract them or upload them one at a time. The functions below read the files straight out of a `.zip`, `.tar`, `.tar.gz` or `.tar.bz2` archive (in Colab, upload the archive with the file browser on the left, or use `files.upload()` once for the archive).
+
+Files are parsed in parallel as they are read, and the profiles are returned in the same order as `sorted(uploaded.keys())` above. Only the file name is used, so it doesn't matter if the files are inside a folder in the archive. If the archive has files with the same name in different folders (for example `TroughA/Profile_01.txt` and `TroughB/Profile_01.txt`), use `keep_folders=True`: the folders are then added to the name (`TroughA_Profile_01.txt`), which also puts each folder in its own group in "Several features at once". Without it, reading stops with an error rather than silently keeping only one of the files.
+"""
+
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_profile(raw_bytes, dtype=np.float64, columns=("x", "y")):
+    # parse one tab-separated profile file, returning the named columns
+    try:
+        # the C parser is much faster than genfromtxt...
+        data = np.loadtxt(io.BytesIO(raw_bytes), delimiter='\t', skiprows=1, ndmin=2, dtype=dtype)
+        names = raw_bytes.split(b'\n', 1)[0].decode().strip().split('\t')
+        by_name = dict(zip(names, data.T))
+    except ValueError:
+        # ...but genfromtxt copes with missing values, which become NaN
+        data = np.genfromtxt(io.BytesIO(raw_bytes), delimiter='\t', names=True, dtype=dtype)
+        by_name = {name: data[name] for name in data.dtype.names}
+    return tuple(by_name[column] for column in columns)
+
+
+def _member_name(path, keep_folders):
+    # "TroughA/Profile_01.txt" -> "Profile_01.txt", or "TroughA_Profile_01.txt" with keep_folders
+    if keep_folders:
+        return path.strip("/").replace("/", "_")
+    return os.path.basename(path)
+
+
+def iter_archive_members(archive_path, keep_folders=False):
+    # yield (file name, file contents) for every .txt file in a zip or tar archive,
+    # reading one member at a time rather than extracting the archive to disk
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and member.filename.endswith(".txt"):
+                    yield _member_name(member.filename, keep_folders), archive.read(member)
+    else:
+        # "r|*" reads the tar as a stream, so compressed archives are decompressed once
+        with tarfile.open(archive_path, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith(".txt"):
+                    yield _member_name(member.name, keep_folders), archive.extractfile(member).read()
+
+
+def load_profiles(members, max_workers=None, dtype=np.float64, columns=("x", "y")):
+    # parse (file name, file contents) pairs in parallel
+    # returns a dictionary of {file name: (x, y)} (or the chosen columns) in sorted file name order
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for name, raw in members:
+            if name in futures:
+                raise ValueError("there is more than one file called " + name + " (in different folders?); "
+                                 "use iter_archive_members(archive_path, keep_folders=True)")
+            futures[name] = executor.submit(parse_profile, raw, dtype, columns)
+    return {name: futures[name].result() for name in sorted(futures)}
+
+
+def read_profile_archive(archive_path, max_workers=None, dtype=np.float64, columns=("x", "y"), keep_folders=False):
+    return load_profiles(iter_archive_members(archive_path, keep_folders), max_workers=max_workers, dtype=dtype, columns=columns)
+
+"""`profiles` holds the parsed `x` and `y` arrays for each file. If there is no archive at `archive_path`, the files uploaded with `files.upload()` are used instead, so the sections below can be used either way. `profile_members()` gives the same files again, for sections that need to re-read them. To read uploaded files yourself:
+
+```
+profiles = load_profiles(uploaded.items())
+```
+
+If you want to use the archive with the plotting cells above, you can instead fill the `uploaded` dictionary directly:
+
+```
+uploaded = dict(iter_archive_members(archive_path))
+```
+"""
+
+archive_path = "profiles.zip"
+keep_folders = False  # True if files in different folders have the same name
+
+
+def profile_members():
+    # (file name, file contents) of every profile: from the archive if there is one,
+    # otherwise the uploaded files
+    if os.path.exists(archive_path):
+        return iter_archive_members(archive_path, keep_folders)
+    return uploaded.items()
+
+
+profiles = load_profiles(profile_members())
+
+# profile labels, formatted the same way as in the plots above
+labels = [format_profile_name(file_name) for file_name in profiles]
+
+print(len(profiles), "profiles:", labels)
+
+"""## Choosing the common x axis automatically
+
+The plots above interpolate every profile onto `np.linspace(x_min, x_max, num=1000)`. `np.interp` repeats the first/last elevation of a profile outside its own range, so where profiles don't overlap they are extended as flat lines, and these flat ends are included in the mean and standard deviation.
+
+The functions below instead:
+
+* put all the profiles into one array (one row per profile, padded with NaN where profiles are shorter), so that alignment is done for all profiles at once;
+* choose the spacing of the common x axis from the spacing of the profiles themselves (the median), and its extent from where the aligned profiles actually have data;
+* leave each profile as NaN outside its own range, and count how many profiles cover each point (the "coverage"), so the mean, standard deviation and peak to peak only use real values.
+"""
+
+def stack_profiles(profiles, dtype=None):
+    # put the profiles into 2D arrays, one row per profile, padded with NaN
+    # (by default the arrays keep the precision the profiles were parsed with)
+    if dtype is None:
+        dtype = np.result_type(*{y.dtype for x, y in profiles.values()})
+    lengths = np.array([len(x) for x, y in profiles.values()])
+    x_stack = np.full((len(profiles), lengths.max()), np.nan, dtype=dtype)
+    y_stack = np.full((len(profiles), lengths.max()), np.nan, dtype=dtype)
+    for i, (x, y) in enumerate(profiles.values()):
+        x_stack[i, :len(x)] = x
+        y_stack[i, :len(y)] = y
+    return x_stack, y_stack, lengths
+
+
+def stack_gradient(x_stack, y_stack, lengths):
+    # np.gradient(y, spacing) of every profile, with spacing = x[1] - x[0] as above
+    rows = np.arange(len(lengths))
+    spacing = x_stack[:, 1] - x_stack[:, 0]
+    y_grad = np.gradient(y_stack, axis=1) / spacing[:, None]
+
+    # the last point of each profile only has a neighbour on the left
+    last = lengths - 1
+    y_grad[rows, last] = (y_stack[rows, last] - y_stack[rows, last - 1]) / spacing
+    return y_grad
+
+
+def align_profiles(x_stack, y_stack, lengths, mode="min_elevation", zero_min=True, anchor_stack=None, y_grad=None):
+    # shift every profile in x so that its anchor point is at x = 0
+    # mode is "none", "min_elevation", "min_slope" (steepest slope on the LHS)
+    # or "max_slope" (steepest slope on the RHS)
+    # if zero_min is True, the lowest point of each profile is also moved to y = 0
+    # anchor_stack (e.g. a smoothed copy of y_stack) is used to find the anchors if given
+    # y_grad, if given, is used as the slope of anchor_stack for the slope modes
+    rows = np.arange(len(lengths))
+    if anchor_stack is None:
+        anchor_stack = y_stack
+
+    if mode == "none":
+        shifts = np.zeros(len(lengths), dtype=x_stack.dtype)
+    else:
+        if mode == "min_elevation":
+            values = anchor_stack
+        elif mode in ("min_slope", "max_slope"):
+            values = stack_gradient(x_stack, anchor_stack, lengths) if y_grad is None else y_grad
+        else:
+            raise ValueError("unknown alignment mode: " + mode)
+
+        # NaN padding must never be picked as the anchor
+        if mode == "max_slope":
+            anchor = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=1)
+        else:
+            anchor = np.argmin(np.where(np.isnan(values), np.inf, values), axis=1)
+        shifts = x_stack[rows, anchor]
+
+    x_aligned = x_stack - shifts[:, None]
+    y_aligned = y_stack - np.nanmin(y_stack, axis=1)[:, None] if zero_min else y_stack.copy()
+    return x_aligned, y_aligned, shifts
+
+
+def build_common_grid(x_stack, min_coverage=1, spacing=None):
+    # common x axis with the median sample spacing of the profiles, covering the
+    # range where at least min_coverage profiles have data
+    if spacing is None:
+        spacing = np.nanmedian(np.diff(x_stack, axis=1))
+
+    starts = np.sort(np.nanmin(x_stack, axis=1))
+    ends = np.sort(np.nanmax(x_stack, axis=1))
+    grid = np.arange(starts[0], ends[-1] + spacing / 2, spacing)
+
+    # number of profiles with start <= x minus those with end < x
+    coverage = np.searchsorted(starts, grid, side='right') - np.searchsorted(ends, grid, side='left')
+    covered = np.flatnonzero(coverage >= min_coverage)
+    if len(covered) == 0:
+        raise ValueError("no part of the x axis is covered by " + str(min_coverage) + " profiles")
+    return grid[covered[0]:covered[-1] + 1]
+
+
+def resample_stack(common_x, x_stack, y_stack, lengths, dtype=None):
+    # interpolate each profile onto common_x, only inside its own x range
+    # (np.interp works in float64; each row is rounded to dtype as it is stored)
+    if dtype is None:
+        dtype = y_stack.dtype
+    interp_y = np.full((len(lengths), len(common_x)), np.nan, dtype=dtype)
+
+    # grid points within rounding error of a profile's end still count as covered
+    tolerance = 1e-3 * (common_x[1] - common_x[0])
+    for i, n in enumerate(lengths):
+        x = x_stack[i, :n]
+        first = np.searchsorted(common_x, x[0] - tolerance, side='left')
+        last = np.searchsorted(common_x, x[-1] + tolerance, side='right')
+        interp_y[i, first:last] = np.interp(common_x[first:last], x, y_stack[i, :n])
+    return interp_y
+
+
+def stack_statistics(interp_y, chunk_rows=1024):
+    # mean, standard deviation and peak to peak at each point of the common x axis,
+    # using only the profiles that cover that point
+    # sums are always accumulated in float64, a block of rows at a time, so a
+    # float32 stack gives stable statistics without a float64 copy of the stack
+    n_points = interp_y.shape[1]
+    coverage = np.zeros(n_points, dtype=np.int64)
+    total = np.zeros(n_points)
+    y_max = np.full(n_points, -np.inf)
+    y_min = np.full(n_points, np.inf)
+    for r0 in range(0, len(interp_y), chunk_rows):
+        block = interp_y[r0:r0 + chunk_rows]
+        valid = ~np.isnan(block)
+        coverage += valid.sum(axis=0)
+        total += np.where(valid, block, 0).sum(axis=0, dtype=np.float64)
+        y_max = np.maximum(y_max, np.where(valid, block, -np.inf).max(axis=0))
+        y_min = np.minimum(y_min, np.where(valid, block, np.inf).min(axis=0))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_y = total / coverage
+
+        # second pass for the standard deviation, which is more accurate than
+        # using the sum of squares
+        squares = np.zeros(n_points)
+        for r0 in range(0, len(interp_y), chunk_rows):
+            block = interp_y[r0:r0 + chunk_rows]
+            deviation = block.astype(np.float64) - avg_y
+            squares += np.where(np.isnan(block), 0, deviation ** 2).sum(axis=0)
+        std_y = np.sqrt(squares / coverage)
+
+    ptp = y_max - y_min
+    ptp[coverage == 0] = np.nan
+    return avg_y, std_y, ptp, coverage
+
+"""This reproduces the "Line Profile Plot centred on zero" above, without having to choose `x_min` and `x_max` or the number of points. The lower panel shows how many profiles contribute to the mean at each point; `min_coverage` trims the ends of the x axis where only a few profiles remain."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+# "none", "min_elevation", "min_slope" or "max_slope"
+alignment = "min_elevation"
+
+# only keep the part of the x axis where at least this many profiles have data
+min_coverage = 3
+
+# Define the height and width of the plot
+plot_height = 8
+plot_width = 12
+
+# with fewer profiles loaded, every profile has to cover the x axis
+min_coverage = min(min_coverage, len(profiles))
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+x_aligned, y_aligned, shifts = align_profiles(x_stack, y_stack, lengths, mode=alignment)
+
+common_x = build_common_grid(x_aligned, min_coverage=min_coverage)
+interp_y = resample_stack(common_x, x_aligned, y_aligned, lengths)
+avg_y, std_y, ptp, coverage = stack_statistics(interp_y)
+
+print("Common x axis:", common_x[0], "to", common_x[-1], "m, spacing", common_x[1] - common_x[0], "m,", len(common_x), "points")
+
+fig, (ax, ax_coverage) = plt.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [4, 1]})
+
+for i, file_name in enumerate(profiles):
+    ax.plot(x_aligned[i], y_aligned[i], label=format_profile_name(file_name), color='grey', alpha=0.5)
+
+ax.plot(common_x, avg_y, label='Average Profile', color='red', linestyle='--', linewidth=2)
+ax.fill_between(common_x, avg_y - std_y, avg_y + std_y, color='red', alpha=0.3)
+ax.set_xlim(common_x[0], common_x[-1])
+ax.set_ylabel('Elevation [m]')
+ax.set_title('Topographic Profiles of Profiles, aligned by ' + alignment.replace("_", " "))
+
+handles, labels = ax.get_legend_handles_labels()
+red_patch = mpatches.Patch(color='red', label='STDev', alpha=0.3)
+handles.append(red_patch)
+ax.legend(handles=handles, loc='center left', bbox_to_anchor=(1, 0.5))
+
+ax_coverage.plot(common_x, coverage, color='k')
+ax_coverage.set_xlabel('Distance [m]')
+ax_coverage.set_ylabel('Profiles')
+
+fig.set_size_inches(plot_width, plot_height)
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""### Using single precision (float32) for large runs
+
+By default numpy stores everything in double precision (float64), which is far more precise than MOLA or HRSC elevations (at best around a metre vertically). For large runs you can parse, stack and resample the profiles in single precision (float32) instead, which halves the memory used by the profiles and the resampled stack. The mean, standard deviation and peak to peak are still accumulated in float64 by `stack_statistics`, so they stay stable for any number of profiles.
+
+How big are the differences compared with float64?
+
+* float32 stores about 7 significant figures, so a value is rounded by at most 1 part in 16 million: under 1 mm for elevations within ±16 km (2 mm up to the top of Olympus Mons), and under 4 mm for distances up to 130 km.
+* `np.interp` works in float64 and only the result is rounded, and the statistics are accumulated in float64, so the resampled profiles, mean, standard deviation and peak to peak differ from the float64 results by a few millimetres at most (for 1000 synthetic profiles from -8 km to +21 km elevation the largest difference was 3 mm).
+* The one thing to watch for is alignment on the slope: if the two steepest gradients of a profile are equal to within this rounding, float32 may pick the neighbouring sample, moving that profile by one sample spacing. The cell below reports any profiles where this happens.
+"""
+
+# set to np.float64 for full precision
+precision = np.float32
+
+# parse the profiles again in single precision
+profiles_single = load_profiles(profile_members(), dtype=precision)
+
+x_single, y_single, lengths = stack_profiles(profiles_single)
+x_aligned_single, y_aligned_single, shifts_single = align_profiles(x_single, y_single, lengths, mode=alignment)
+interp_y_single = resample_stack(common_x, x_aligned_single, y_aligned_single, lengths)
+avg_y_single, std_y_single, ptp_single, coverage_single = stack_statistics(interp_y_single)
+
+# compare with the float64 results from the cell above
+print("Resampled stack:", interp_y.nbytes // 1024, "KiB in float64,", interp_y_single.nbytes // 1024, "KiB in", np.dtype(precision).name)
+print("Largest difference in the resampled profiles:", np.nanmax(np.abs(interp_y_single - interp_y)), "m")
+print("Largest difference in the mean:", np.nanmax(np.abs(avg_y_single - avg_y)), "m")
+print("Largest difference in the standard deviation:", np.nanmax(np.abs(std_y_single - std_y)), "m")
+print("Profiles aligned on a different sample:", [file_name for file_name, a, b in zip(profiles, shifts, shifts_single) if abs(a - b) > 0.5 * (common_x[1] - common_x[0])])
+
+"""## Bootstrap confidence bands for the mean profile
+
+The standard deviation band shows how much the profiles vary, not how well the mean profile is known. A bootstrap gives a confidence interval on the mean (or median) profile: the profiles are resampled with replacement many times, the mean is recalculated for each resample, and the spread of those means gives the interval.
+
+Rather than looping over resamples one at a time, resamples are processed in chunks sized to fit within `memory_budget`, and chunks run in parallel on all the available cores (on fewer cores if the budget doesn't leave room for a chunk on each). For the mean, each resample is written as the number of times each profile was picked, so a whole chunk is a single matrix multiplication. Every block of 64 resamples gets its own random seed derived from `seed`, so the result is the same whatever the number of cores or the memory budget.
+"""
+
+import warnings
+
+
+# each seed drives this many resamples, so the results don't depend on the chunk size
+BOOTSTRAP_SEED_BLOCK = 64
+
+
+def _bootstrap_chunk(interp_y, filled, valid, statistic, block_sizes, seeds, max_rows):
+    # the resamples of the given seed blocks, at most max_rows resampled stacks at a time
+    n_profiles, n_points = interp_y.shape
+
+    if statistic == "mean":
+        # how many times each profile appears in each resample
+        counts = np.concatenate([
+            np.random.default_rng(s).multinomial(n_profiles, np.full(n_profiles, 1 / n_profiles), size=n)
+            for n, s in zip(block_sizes, seeds)]).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (counts @ filled) / (counts @ valid)
+
+    # medians need the resampled profiles themselves
+    picks = np.concatenate([np.random.default_rng(s).integers(0, n_profiles, size=(n, n_profiles))
+                            for n, s in zip(block_sizes, seeds)])
+    median = np.empty((len(picks), n_points))
+    for r0 in range(0, len(picks), max_rows):
+        # sorted in place, so the only copy of the profiles is the resampled stack itself
+        resampled = interp_y[picks[r0:r0 + max_rows]]
+        resampled.sort(axis=1)
+
+        # NaNs sort to the end, so the median is the middle of the first n_valid values
+        n_valid = n_profiles - np.isnan(resampled).sum(axis=1, keepdims=True)
+        low = np.take_along_axis(resampled, np.maximum(n_valid - 1, 0) // 2, axis=1)
+        high = np.take_along_axis(resampled, n_valid // 2 - (n_valid == 0), axis=1)
+        median[r0:r0 + max_rows] = (low[:, 0] + high[:, 0]) / 2
+        median[r0:r0 + max_rows][n_valid[:, 0] == 0] = np.nan
+        del resampled
+    return median
+
+
+def bootstrap_bands(interp_y, statistic="mean", n_boot=10000, ci=95, seed=0,
+                    memory_budget=512 * 1024**2, max_workers=None):
+    # confidence band on the mean or median profile of a resampled stack
+    # (NaN outside a profile's range is allowed, as from resample_stack)
+    # returns the lower and upper edge of the band at each point of the common x axis
+    if statistic not in ("mean", "median"):
+        raise ValueError("statistic must be 'mean' or 'median'")
+    max_workers = max_workers or os.cpu_count()
+    n_profiles, n_points = interp_y.shape
+    valid = ~np.isnan(interp_y)
+    if statistic == "mean":
+        filled = np.where(valid, interp_y, 0).astype(np.float64)
+        valid = valid.astype(np.float64)
+    else:
+        filled = None
+
+    # memory used per resample while a chunk is being processed
+    if statistic == "mean":
+        per_resample = 8 * (n_profiles + 2 * n_points)
+    else:
+        # the resampled stack (sorted in place), its NaN mask, the picks and the median rows
+        per_resample = (interp_y.itemsize + 1) * n_profiles * n_points + 8 * n_profiles + 32 * n_points
+
+    # the bootstrap results themselves are kept in float32
+    results = np.empty((n_boot, n_points), dtype=np.float32)
+    budget = max(memory_budget - results.nbytes, 0)
+    # fewer workers if the budget doesn't allow one resample for each of them
+    max_workers = int(min(max_workers, max(budget // per_resample, 1)))
+    chunk_size = int(max(budget // (per_resample * max_workers), 1))
+    blocks_per_chunk = int(max(chunk_size // BOOTSTRAP_SEED_BLOCK, 1))
+
+    block_starts = np.arange(0, n_boot, BOOTSTRAP_SEED_BLOCK)
+    block_sizes = np.minimum(BOOTSTRAP_SEED_BLOCK, n_boot - block_starts)
+    seeds = np.random.SeedSequence(seed).spawn(len(block_starts))
+
+    def run(first_block):
+        blocks = slice(first_block, first_block + blocks_per_chunk)
+        start = block_starts[first_block]
+        n = block_sizes[blocks].sum()
+        results[start:start + n] = _bootstrap_chunk(interp_y, filled, valid, statistic,
+                                                    block_sizes[blocks], seeds[blocks], chunk_size)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run, range(0, len(block_starts), blocks_per_chunk)))
+
+    tail = (100 - ci) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lower, upper = np.nanpercentile(results, [tail, 100 - tail], axis=0)
+    return lower, upper
+
+"""The plot below uses the stack from "Choosing the common x axis automatically", and shows the 95% confidence band on the mean alongside the usual standard deviation band. Set `bootstrap_statistic = "median"` for a band on the median profile (this is slower, as each resample has to be sorted)."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+bootstrap_statistic = "mean"  # "mean" or "median"
+n_boot = 10000
+confidence = 95  # percent
+
+# Define the height and width of the plot
+plot_height = 8
+plot_width = 12
+
+lower, upper = bootstrap_bands(interp_y, statistic=bootstrap_statistic, n_boot=n_boot, ci=confidence, seed=0)
+
+if bootstrap_statistic == "median":
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        centre_y = np.nanmedian(interp_y, axis=0)
+else:
+    centre_y = avg_y
+
+for i, file_name in enumerate(profiles):
+    plt.plot(x_aligned[i], y_aligned[i], color='grey', alpha=0.3)
+
+plt.fill_between(common_x, avg_y - std_y, avg_y + std_y, color='grey', alpha=0.3)
+plt.fill_between(common_x, lower, upper, color='red', alpha=0.5)
+plt.plot(common_x, centre_y, label=bootstrap_statistic.capitalize() + ' Profile', color='k', linestyle='-', linewidth=2.5, alpha=0.7)
+
+plt.xlim(common_x[0], common_x[-1])
+plt.gcf().set_size_inches(plot_width, plot_height)
+
+plt.xlabel('Distance [m]')
+plt.ylabel('Elevation [m]')
+plt.title('Topographic Profiles of Profiles, with bootstrap confidence band')
+
+handles, labels = plt.gca().get_legend_handles_labels()
+handles.append(mpatches.Patch(color='grey', label='St. Dev.', alpha=0.3))
+handles.append(mpatches.Patch(color='red', label=str(confidence) + '% confidence', alpha=0.5))
+plt.legend(handles=handles, loc='center left', bbox_to_anchor=(1, 0.5))
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Grouping similar profiles
+
+With hundreds of adjacent profiles it can be useful to find which ones look alike, for example to see where a trough changes shape along its length. This section compares every pair of resampled profiles, then groups them with hierarchical clustering and plots the mean and standard deviation of each group.
+
+Three ways of measuring the difference between two profiles are available:
+
+* `"rmse"`: the root mean square difference in elevation [m], over the points both profiles cover;
+* `"correlation"`: 1 minus the correlation coefficient, so profiles with the same shape are similar even if one is deeper;
+* `"dtw"`: dynamic time warping, which allows the profiles to stretch or shift along x by up to `band` points before comparing them (useful when the alignment isn't perfect). This needs profiles without gaps, so the common x axis should be built with `min_coverage` equal to the number of profiles.
+
+The distances are calculated for blocks of profiles at a time using matrix operations, rather than a Python loop over every pair. For very large sets the distance matrix can be written to a file on disk (`out="distances.npy"`) instead of being kept in memory.
+"""
+
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+
+
+def _block_distances(y_a, y_b, metric):
+    # distances between every row of y_a and every row of y_b, only using the
+    # points both profiles cover; the sums are all matrix products
+    valid_a = ~np.isnan(y_a)
+    valid_b = ~np.isnan(y_b)
+    a = np.where(valid_a, y_a, 0).astype(np.float64)
+    b = np.where(valid_b, y_b, 0).astype(np.float64)
+    va = valid_a.astype(np.float64)
+    vb = valid_b.astype(np.float64)
+
+    n = va @ vb.T
+    sum_a = a @ vb.T
+    sum_b = va @ b.T
+    sum_aa = (a * a) @ vb.T
+    sum_bb = va @ (b * b).T
+    sum_ab = a @ b.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if metric == "rmse":
+            return np.sqrt(np.maximum(sum_aa + sum_bb - 2 * sum_ab, 0) / n)
+        cov = sum_ab - sum_a * sum_b / n
+        var_a = sum_aa - sum_a ** 2 / n
+        var_b = sum_bb - sum_b ** 2 / n
+        return 1 - cov / np.sqrt(np.maximum(var_a * var_b, 0))
+
+
+def _block_dtw(y_a, y_b, band):
+    # banded dynamic time warping between every row of y_a and every row of y_b
+    # all the pairs are processed together, one row of the cost matrix at a time
+    n_points = y_a.shape[1]
+    width = 2 * band + 1
+    a = y_a[:, None, :].astype(np.float64)
+    b = y_b[None, :, :].astype(np.float64)
+    offsets = np.arange(-band, band + 1)
+
+    # previous row of the cumulative cost, indexed by j - i + band
+    previous = np.full(y_a.shape[:1] + y_b.shape[:1] + (width,), np.inf)
+    for i in range(n_points):
+        j = i + offsets
+        inside = (j >= 0) & (j < n_points)
+        cost = np.full(previous.shape, np.inf)
+        cost[..., inside] = np.abs(a[..., i:i + 1] - b[..., j[inside]])
+
+        if i == 0:
+            # the first row can only be reached by horizontal steps from (0, 0)
+            row = np.full(previous.shape, np.inf)
+            row[..., band:] = np.cumsum(cost[..., band:], axis=-1)
+        else:
+            # diagonal step (i-1, j-1) and vertical step (i-1, j)
+            diagonal = previous
+            vertical = np.concatenate([previous[..., 1:], np.full(previous.shape[:-1] + (1,), np.inf)], axis=-1)
+            step = cost + np.minimum(diagonal, vertical)
+
+            # horizontal steps (i, j-1): D[j] = min(step[j], D[j-1] + cost[j]), which is
+            # a running minimum once the cumulative cost along the row is removed
+            finite_cost = np.where(inside, cost, 0)
+            along = np.cumsum(finite_cost, axis=-1)
+            row = along + np.minimum.accumulate(step - along, axis=-1)
+            row[..., ~inside] = np.inf
+        previous = row
+
+    # the end of the path is at (n - 1, n - 1), i.e. offset 0
+    return previous[..., band]
+
+
+def profile_distances(interp_y, metric="rmse", band=10, block_size=256, out=None):
+    # full matrix of distances between every pair of resampled profiles
+    # out can be the name of a .npy file to write the matrix to instead of memory
+    if metric not in ("rmse", "correlation", "dtw"):
+        raise ValueError("metric must be 'rmse', 'correlation' or 'dtw'")
+    if metric == "dtw" and np.isnan(interp_y).any():
+        raise ValueError("dtw needs profiles without gaps; build the common x axis with min_coverage = number of profiles")
+
+    n_profiles = len(interp_y)
+    if out is None:
+        distances = np.zeros((n_profiles, n_profiles))
+    else:
+        distances = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(n_profiles, n_profiles))
+
+    # dtw works on (block, block, band) arrays, so use smaller blocks
+    if metric == "dtw":
+        block_size = max(1, block_size // 8)
+
+    # only the upper triangle of blocks is calculated; the matrix is symmetric
+    for r0 in range(0, n_profiles, block_size):
+        for c0 in range(r0, n_profiles, block_size):
+            y_a = interp_y[r0:r0 + block_size]
+            y_b = interp_y[c0:c0 + block_size]
+            if metric == "dtw":
+                block = _block_dtw(y_a, y_b, band)
+            else:
+                block = _block_distances(y_a, y_b, metric)
+            distances[r0:r0 + len(y_a), c0:c0 + len(y_b)] = block
+            distances[c0:c0 + len(y_b), r0:r0 + len(y_a)] = block.T
+
+    np.fill_diagonal(distances, 0)
+    if out is not None:
+        distances.flush()
+    return distances
+
+
+def cluster_profiles(distances, n_clusters, method="average"):
+    # hierarchical clustering of the profiles; returns a cluster number (1, 2, ...)
+    # for each profile and the linkage matrix (for scipy's dendrogram)
+    # profiles that don't overlap at all are treated as far apart
+    finite = np.where(np.isfinite(distances), distances, np.nanmax(distances[np.isfinite(distances)]) * 2)
+    tree = linkage(squareform(finite, checks=False), method=method)
+    return fcluster(tree, n_clusters, criterion='maxclust'), tree
+
+"""The example below uses the resampled profiles from "Choosing the common x axis automatically", and plots each group in its own panel, with the group mean and standard deviation as in the plots above."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+distance_metric = "rmse"  # "rmse", "correlation" or "dtw"
+n_clusters = 3
+
+# Define the height and width of each panel
+plot_height = 4
+plot_width = 12
+
+distances = profile_distances(interp_y, metric=distance_metric)
+clusters, tree = cluster_profiles(distances, n_clusters)
+
+fig, axes = plt.subplots(n_clusters, 1, sharex=True, sharey=True, squeeze=False)
+
+for k, ax in enumerate(axes[:, 0], start=1):
+    members = clusters == k
+    cluster_avg_y, cluster_std_y, cluster_ptp, cluster_coverage = stack_statistics(interp_y[members])
+
+    for i in np.flatnonzero(members):
+        ax.plot(x_aligned[i], y_aligned[i], color='grey', alpha=0.5)
+
+    ax.plot(common_x, cluster_avg_y, color='red', linestyle='--', linewidth=2)
+    ax.fill_between(common_x, cluster_avg_y - cluster_std_y, cluster_avg_y + cluster_std_y, color='red', alpha=0.3)
+    ax.set_ylabel('Elevation [m]')
+
+    # list the profiles in each group
+    names = [format_profile_name_2(file_name) for file_name, member in zip(profiles, members) if member]
+    ax.set_title('Group ' + str(k) + ':' + ','.join(names), fontsize='small')
+
+axes[-1, 0].set_xlabel('Distance [m]')
+axes[-1, 0].set_xlim(common_x[0], common_x[-1])
+fig.set_size_inches(plot_width, plot_height * n_clusters)
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Table of measurements for every profile
+
+The stacked plot in "Other plots" finds the maximum elevation, minimum elevation and maximum slope of each profile one at a time, just to draw them. The function below measures all the profiles at once and returns a table with one row per profile, which can be saved as a CSV (or Parquet) file for statistics in other software.
+
+For each profile, the floor is the lowest point, and the rims are the highest points on either side of the floor. The columns are:
+
+* `floor_x`, `floor_y`, `left_rim_x`, `left_rim_y`, `right_rim_x`, `right_rim_y`: positions of the floor and rims [m];
+* `max_slope_x`, `min_slope_x`: positions of the steepest rising (RHS) and falling (LHS) slopes, as used for alignment above [m];
+* `depth`: height of the lower rim above the floor [m];
+* `width`: rim-to-rim width [m];
+* `left_slope`, `right_slope`: mean slope of each flank, from rim to floor [degrees];
+* `asymmetry`: (left flank width - right flank width) / rim-to-rim width, which is 0 for a floor halfway between the rims and negative if the floor is nearer the left rim;
+* `area`: cross-sectional area between the profile and the level of the lower rim [m²].
+"""
+
+import csv
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def morphometrics(names, x_stack, y_stack, lengths):
+    # measure every profile of a stack from stack_profiles at once
+    # returns a dictionary of {column name: array with one value per profile}
+    rows = np.arange(len(lengths))
+    columns = np.arange(x_stack.shape[1])[None, :]
+    valid = ~np.isnan(y_stack)
+
+    floor = np.argmin(np.where(valid, y_stack, np.inf), axis=1)
+    floor_y = y_stack[rows, floor]
+
+    # highest point on each side of the floor (including the floor itself)
+    left_side = valid & (columns <= floor[:, None])
+    right_side = valid & (columns >= floor[:, None])
+    left_rim = np.argmax(np.where(left_side, y_stack, -np.inf), axis=1)
+    right_rim = np.argmax(np.where(right_side, y_stack, -np.inf), axis=1)
+    left_rim_y = y_stack[rows, left_rim]
+    right_rim_y = y_stack[rows, right_rim]
+
+    y_grad = stack_gradient(x_stack, y_stack, lengths)
+    max_slope = np.argmax(np.where(valid, y_grad, -np.inf), axis=1)
+    min_slope = np.argmin(np.where(valid, y_grad, np.inf), axis=1)
+
+    floor_x = x_stack[rows, floor]
+    left_rim_x = x_stack[rows, left_rim]
+    right_rim_x = x_stack[rows, right_rim]
+    rim_level = np.minimum(left_rim_y, right_rim_y)
+    width = right_rim_x - left_rim_x
+
+    # area below the lower rim level and between the rims (trapezium rule)
+    between = valid & (columns >= left_rim[:, None]) & (columns <= right_rim[:, None])
+    below = np.where(between, np.clip(rim_level[:, None] - y_stack, 0, None), 0)
+    area = np.nansum((below[:, 1:] + below[:, :-1]) / 2 * np.diff(x_stack, axis=1), axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        left_slope = np.degrees(np.arctan((left_rim_y - floor_y) / (floor_x - left_rim_x)))
+        right_slope = np.degrees(np.arctan((right_rim_y - floor_y) / (right_rim_x - floor_x)))
+        asymmetry = ((floor_x - left_rim_x) - (right_rim_x - floor_x)) / width
+
+    return {
+        "name": np.asarray(names),
+        "floor_x": floor_x,
+        "floor_y": floor_y,
+        "left_rim_x": left_rim_x,
+        "left_rim_y": left_rim_y,
+        "right_rim_x": right_rim_x,
+        "right_rim_y": right_rim_y,
+        "max_slope_x": x_stack[rows, max_slope],
+        "min_slope_x": x_stack[rows, min_slope],
+        "depth": rim_level - floor_y,
+        "width": width,
+        "left_slope": left_slope,
+        "right_slope": right_slope,
+        "asymmetry": asymmetry,
+        "area": area,
+    }
+
+
+def write_table_csv(table, file_name):
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(table.keys())
+        writer.writerows(zip(*[column.tolist() for column in table.values()]))
+
+
+def write_table_parquet(table, file_name):
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to write Parquet files (or use write_table_csv)")
+    pyarrow.parquet.write_table(pyarrow.table(table), file_name)
+
+"""Measure the profiles loaded in "Reading profiles from a zip or tar archive", and set `save_table = True` to save the table. In Colab, the saved file appears in the file browser on the left, where you can download it."""
+
+save_table = False
+
+# Ensure the file name ends in csv or parquet (depending on which filetype you want)
+table_file_name = "morphometrics.csv"
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+table = morphometrics(list(profiles), x_stack, y_stack, lengths)
+
+# print the first few rows
+for column, values in table.items():
+    print(column, values[:5])
+
+if save_table:
+    if table_file_name.endswith(".parquet"):
+        write_table_parquet(table, table_file_name)
+    else:
+        write_table_csv(table, table_file_name)
+
+"""## Smoothing the profiles
+
+The slope of raw DEM samples (`np.gradient(y, spacing)`) is very sensitive to noise: a single bad pixel can become the "steepest slope" that a profile is aligned on. `smooth_stack` smooths every profile of a stack in one call, with one of three filters:
+
+* `"moving_average"`: the mean of `size` neighbouring points (calculated from cumulative sums, so it is equally fast for any size);
+* `"gaussian"`: a Gaussian weighted mean with a standard deviation of `size` points (calculated by multiplying Fourier transforms, which is fast for wide filters);
+* `"savgol"`: a Savitzky–Golay filter, which fits a polynomial of order `polyorder` to each window of `size` points; it keeps the height of sharp features better than the other two.
+
+The smoothed profiles are the same length as the originals: beyond the ends of each profile, the first and last elevations are repeated.
+
+To align on the smoothed slope while still plotting the original profiles, pass the smoothed stack to `align_profiles` as `anchor_stack`.
+"""
+
+from scipy.signal import savgol_filter
+
+
+def fill_padding(y_stack, lengths):
+    # copy of the stack with the NaN padding after each profile replaced by the
+    # profile's last value, so filters can run along whole rows
+    last = y_stack[np.arange(len(lengths)), lengths - 1]
+    padding = np.arange(y_stack.shape[1])[None, :] >= lengths[:, None]
+    return np.where(padding, last[:, None], y_stack)
+
+
+def smooth_stack(y_stack, lengths, method="moving_average", size=5, polyorder=2):
+    # smooth every profile of a stack from stack_profiles
+    # size is the number of points for "moving_average" and "savgol", and the
+    # standard deviation in points for "gaussian"
+    padding = np.isnan(y_stack)
+    filled = fill_padding(y_stack, lengths).astype(np.float64)
+
+    if method == "moving_average":
+        if size <= 1:
+            return y_stack.copy()
+        half = size // 2
+        extended = np.pad(filled, ((0, 0), (half, size - half)), mode='edge')
+        sums = np.cumsum(np.pad(extended, ((0, 0), (1, 0))), axis=1)
+        # the sum of the size points centred on each point, by differencing the cumulative sums
+        smoothed = (sums[:, size:] - sums[:, :-size])[:, :y_stack.shape[1]] / size
+
+    elif method == "gaussian":
+        radius = int(4 * size + 0.5)
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / size) ** 2)
+        kernel /= kernel.sum()
+        extended = np.pad(filled, ((0, 0), (radius, radius)), mode='edge')
+
+        # convolution of every row with the kernel, by multiplying Fourier transforms
+        n_fft = extended.shape[1] + len(kernel) - 1
+        smoothed = np.fft.irfft(np.fft.rfft(extended, n_fft, axis=1) * np.fft.rfft(kernel, n_fft), n_fft, axis=1)
+        smoothed = smoothed[:, 2 * radius:2 * radius + y_stack.shape[1]]
+
+    elif method == "savgol":
+        smoothed = savgol_filter(filled, size, polyorder, axis=1, mode='nearest')
+
+    else:
+        raise ValueError("method must be 'moving_average', 'gaussian' or 'savgol'")
+
+    smoothed = smoothed.astype(y_stack.dtype)
+    smoothed[padding] = np.nan
+    return smoothed
+
+"""This plot shows one profile with each of the filters, and the slope calculated from each. Try changing `smooth_size` to see how much each filter removes."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+smooth_size = 5
+profile_index = 0  # which profile to show
+
+# Define the height and width of the plot
+plot_height = 8
+plot_width = 12
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+n = lengths[profile_index]
+
+fig, (ax, ax_slope) = plt.subplots(2, 1, sharex=True)
+
+ax.plot(x_stack[profile_index, :n], y_stack[profile_index, :n], color='grey', lw=3, alpha=0.5, label='Original')
+ax_slope.plot(x_stack[profile_index, :n], stack_gradient(x_stack, y_stack, lengths)[profile_index, :n], color='grey', lw=3, alpha=0.5)
+
+for method, color in zip(["moving_average", "gaussian", "savgol"], ["C0", "C1", "C2"]):
+    y_smooth = smooth_stack(y_stack, lengths, method=method, size=smooth_size)
+    ax.plot(x_stack[profile_index, :n], y_smooth[profile_index, :n], color=color, label=method.replace("_", " "))
+    ax_slope.plot(x_stack[profile_index, :n], stack_gradient(x_stack, y_smooth, lengths)[profile_index, :n], color=color)
+
+ax.set_ylabel('Elevation [m]')
+ax.set_title(format_profile_name(list(profiles)[profile_index]))
+ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+ax_slope.set_ylabel('Slope [m/m]')
+ax_slope.set_xlabel('Distance [m]')
+fig.set_size_inches(plot_width, plot_height)
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Finding ledges and breaks in slope
+
+Aligning on the maximum slope takes the single steepest point of each profile (`np.argmax(y_grad)`), which can jump between ledges when a profile has more than one step. The function below finds all the significant features in every profile at once:
+
+* **ledges** are steep sections, i.e. peaks in the (smoothed) slope: `"ledge_up"` where the profile rises steeply to the right (like the RHS ledge above) and `"ledge_down"` where it falls steeply;
+* **breaks in slope** (knickpoints) are sharp changes in slope, i.e. peaks in the curvature: `"break_concave"` where the slope increases (e.g. the foot of a wall) and `"break_convex"` where it decreases (e.g. the top of a wall or a rim).
+
+The elevations are first smoothed with `smooth_stack` (by default a moving average over `smooth` points), to stop single-pixel noise producing features. A peak only counts if it stands out from its surroundings (its "prominence", measured within `window` points either side) by at least `threshold` times the largest slope (or curvature) of that profile, so the same settings work for shallow and deep features.
+
+The features of each profile can be used to align the profiles (for example on the rightmost steep rising ledge, rather than the steepest one) and to mark them on plots.
+"""
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+FEATURE_KINDS = ("ledge_up", "ledge_down", "break_concave", "break_convex")
+
+
+def _peaks(signal, window, threshold):
+    # mask of local maxima of each row that are at least threshold[row] more
+    # prominent than the lowest point within window points on either side
+    ignore = np.isnan(signal)
+    peak = np.zeros(signal.shape, dtype=bool)
+    peak[:, 1:-1] = (signal[:, 1:-1] > signal[:, :-2]) & (signal[:, 1:-1] >= signal[:, 2:])
+
+    padded = np.pad(np.where(ignore, np.inf, signal), ((0, 0), (window, window)), constant_values=np.inf)
+    windows = sliding_window_view(padded, window + 1, axis=1)
+    left_min = windows[:, :signal.shape[1]].min(axis=2)
+    right_min = windows[:, window:].min(axis=2)
+    with np.errstate(invalid='ignore'):
+        prominence = signal - np.maximum(left_min, right_min)
+    return peak & ~ignore & (prominence >= threshold[:, None]), prominence
+
+
+def detect_features(x_stack, y_stack, lengths, smooth=5, window=10, threshold=0.2, smooth_method="moving_average"):
+    # find ledges and breaks in slope in every profile of a stack from stack_profiles
+    # returns a list with, for each profile, a dictionary of
+    # {feature kind: array of indices into that profile, left to right}
+    # plus the prominence of every point, for each kind
+    smoothed = smooth_stack(y_stack, lengths, method=smooth_method, size=smooth)
+    slope = stack_gradient(x_stack, smoothed, lengths)
+    curvature = stack_gradient(x_stack, slope, lengths)
+
+    signals = {
+        "ledge_up": slope,
+        "ledge_down": -slope,
+        "break_concave": curvature,
+        "break_convex": -curvature,
+    }
+
+    features = [dict() for _ in lengths]
+    prominences = {}
+    for kind, signal in signals.items():
+        # prominence needed, relative to the largest slope or curvature of each profile
+        largest = np.nanmax(np.abs(signal), axis=1)
+        mask, prominences[kind] = _peaks(signal, window, threshold * largest)
+
+        # a ledge_down must actually fall, a concave break must steepen upwards, etc.
+        mask &= signal > 0
+
+        # nonzero returns the features sorted by profile, then along the profile
+        rows, columns = np.nonzero(mask)
+        per_profile = np.split(columns, np.searchsorted(rows, np.arange(1, len(lengths))))
+        for profile_features, indices in zip(features, per_profile):
+            profile_features[kind] = indices
+    return features, prominences
+
+
+def feature_anchors(features, prominences, kind="ledge_up", pick="rightmost", fallback=None):
+    # one index per profile: the rightmost, leftmost or most prominent feature of this kind
+    # profiles without any such feature use the fallback index (e.g. np.argmax(y_grad))
+    if pick not in ("rightmost", "leftmost", "most_prominent"):
+        raise ValueError("pick must be 'rightmost', 'leftmost' or 'most_prominent'")
+    anchors = np.zeros(len(features), dtype=int) if fallback is None else np.array(fallback)
+    for i, profile_features in enumerate(features):
+        indices = profile_features[kind]
+        if len(indices) == 0:
+            continue
+        if pick == "rightmost":
+            anchors[i] = indices[-1]
+        elif pick == "leftmost":
+            anchors[i] = indices[0]
+        elif pick == "most_prominent":
+            anchors[i] = indices[np.argmax(prominences[kind][i, indices])]
+    return anchors
+
+"""This plot aligns the profiles on a chosen ledge, like "Align plots based on the maximum slope", and marks every feature found. Try changing `smooth`, `window` and `threshold` until the markers fall on the features you can see."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+# feature detection settings
+smooth = 5       # points in the moving average
+window = 10      # points either side used to measure prominence
+threshold = 0.2  # minimum prominence, as a fraction of the largest slope/curvature
+
+# which feature to align on: one of FEATURE_KINDS, and "rightmost", "leftmost" or "most_prominent"
+align_kind = "ledge_up"
+align_pick = "rightmost"
+
+# Define the height and width of the plot
+plot_height = 8
+plot_width = 12
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+features, prominences = detect_features(x_stack, y_stack, lengths, smooth=smooth, window=window, threshold=threshold)
+
+# profiles without the chosen feature fall back to the steepest slope
+y_grad = stack_gradient(x_stack, y_stack, lengths)
+steepest = np.argmax(np.where(np.isnan(y_grad), -np.inf, y_grad), axis=1)
+anchors = feature_anchors(features, prominences, kind=align_kind, pick=align_pick, fallback=steepest)
+
+rows = np.arange(len(lengths))
+x_shifted = x_stack - x_stack[rows, anchors][:, None]
+y_shifted = y_stack - np.nanmin(y_stack, axis=1)[:, None]
+
+n = len(profiles)
+colors = plt.cm.plasma(np.linspace(0, 1, n + 2))
+markers = {"ledge_up": "^", "ledge_down": "v", "break_concave": "o", "break_convex": "s"}
+
+for i, file_name in enumerate(profiles):
+    plt.plot(x_shifted[i], y_shifted[i], label=format_profile_name(file_name), color=colors[i], ls="--", lw=2, alpha=0.7)
+    for kind, marker in markers.items():
+        indices = features[i][kind]
+        plt.plot(x_shifted[i, indices], y_shifted[i, indices], marker=marker, color=colors[i], ms=5, ls='')
+
+plt.gcf().set_size_inches(plot_width, plot_height)
+plt.xlabel('Distance [m]')
+plt.ylabel('Elevation [m]')
+plt.title('Topographic Profiles of Profiles, aligned on the ' + align_pick.replace("_", " ") + ' ' + align_kind.replace("_", " "))
+
+handles, labels = plt.gca().get_legend_handles_labels()
+for kind, marker in markers.items():
+    handles.append(Line2D([0], [0], marker=marker, markersize=5, markeredgecolor='grey', markerfacecolor='grey', linestyle='', label=kind.replace("_", " ")))
+plt.legend(handles=handles, loc='center left', bbox_to_anchor=(1, 0.5))
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Removing the regional slope
+
+On sloping terrain, shifting each profile so its lowest point is at 0 (`y - np.min(y)`) still leaves the regional tilt in every profile. The tilt makes the standard deviation larger than it should be, and can move the lowest point and the steepest slope that the profiles are aligned on.
+
+`detrend_profiles` fits a straight line (`degree = 1`) or a low-order polynomial to each profile and removes it. The fit can use the whole profile (`fit_on = "all"`), or only the flanks (`fit_on = "flanks"`, the first and last `flank_fraction` of each profile) so the feature itself doesn't affect the fit. Only the tilt (and curvature) is removed, not the average elevation: the trend removed averages 0 over the points it was fitted to, whatever the `degree`.
+
+All the profiles are fitted together: the least squares equations of every profile are built as one stack of small matrices and solved in a single call, rather than calling `np.polyfit` once per profile.
+"""
+
+def detrend_profiles(x_stack, y_stack, lengths, degree=1, fit_on="flanks", flank_fraction=0.2):
+    # remove a polynomial trend from every profile of a stack from stack_profiles
+    # returns the detrended stack and the trend that was removed
+    if fit_on not in ("all", "flanks"):
+        raise ValueError("fit_on must be 'all' or 'flanks'")
+    rows = np.arange(len(lengths))
+    valid = ~np.isnan(y_stack)
+
+    # x scaled to -1..1 along each profile keeps the equations well conditioned
+    x_start = x_stack[:, 0]
+    x_end = x_stack[rows, lengths - 1]
+    centre = (x_start + x_end) / 2
+    half_range = (x_end - x_start) / 2
+    u = np.where(valid, (x_stack - centre[:, None]) / half_range[:, None], 0)
+
+    # weight 1 for the points used in the fit, 0 for the rest
+    weights = valid.astype(float)
+    if fit_on == "flanks":
+        position = np.arange(x_stack.shape[1])[None, :] / (lengths[:, None] - 1)
+        weights *= (position <= flank_fraction) | (position >= 1 - flank_fraction)
+
+    # least squares normal equations (V^T W V) c = V^T W y for every profile at once
+    powers = u[:, :, None] ** np.arange(degree + 1)
+    y = np.where(valid, y_stack, 0)
+    lhs = np.einsum('nl,nlp,nlq->npq', weights, powers, powers)
+    rhs = np.einsum('nl,nlp,nl->np', weights, powers, y)
+    coefficients = np.linalg.solve(lhs, rhs[:, :, None])[:, :, 0]
+
+    # the trend is moved to average 0 over the fitted points, so only the tilt (and
+    # higher terms) is removed: for degree >= 2 the u**2 term doesn't average 0 by itself
+    trend = np.einsum('nlp,np->nl', powers, coefficients)
+    trend -= (np.sum(weights * trend, axis=1) / np.sum(weights, axis=1))[:, None]
+    trend[~valid] = np.nan
+    return y_stack - trend, trend
+
+"""The plot compares the mean and standard deviation before (left) and after (right) removing the regional slope, using the alignment chosen in "Choosing the common x axis automatically"."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+degree = 1  # 1 for a straight line, 2 for a parabola, ...
+fit_on = "flanks"  # "flanks" or "all"
+flank_fraction = 0.2
+
+# Define the height and width of the plot
+plot_height = 6
+plot_width = 16
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+y_detrended, trend = detrend_profiles(x_stack, y_stack, lengths, degree=degree, fit_on=fit_on, flank_fraction=flank_fraction)
+
+fig, axes = plt.subplots(1, 2, sharey=True)
+
+for ax, y_input, title in zip(axes, [y_stack, y_detrended], ["Original", "Regional slope removed"]):
+    panel_x, panel_y, panel_shifts = align_profiles(x_stack, y_input, lengths, mode=alignment)
+    panel_common_x = build_common_grid(panel_x, min_coverage=min_coverage)
+    panel_avg_y, panel_std_y, panel_ptp, panel_coverage = stack_statistics(resample_stack(panel_common_x, panel_x, panel_y, lengths))
+
+    for i in range(len(lengths)):
+        ax.plot(panel_x[i], panel_y[i], color='grey', alpha=0.5)
+    ax.plot(panel_common_x, panel_avg_y, color='red', linestyle='--', linewidth=2)
+    ax.fill_between(panel_common_x, panel_avg_y - panel_std_y, panel_avg_y + panel_std_y, color='red', alpha=0.3)
+
+    ax.set_xlim(panel_common_x[0], panel_common_x[-1])
+    ax.set_xlabel('Distance [m]')
+    ax.set_title(title + ", mean St. Dev. = " + str(round(np.nanmean(panel_std_y), 1)) + " m")
+
+axes[0].set_ylabel('Elevation [m]')
+fig.set_size_inches(plot_width, plot_height)
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Interactive explorer
+
+Rather than editing `x_min`, `x_max`, `y_min`, `y_max` and the alignment and re-running a cell, you can use the explorer below, which has sliders for the axis ranges and a menu for the alignment.
+
+Every alignment is calculated once when the explorer is created (`precompute_alignments`). After that, moving a slider only selects part of the stored arrays and updates the existing lines on the plot, rather than recalculating anything.
+
+Drawing the profile lines themselves still takes time in proportion to the number of points drawn, so:
+
+* long profiles are thinned to about `max_points` points each (default 1000, about the width of the plot in pixels): each run of neighbouring points is replaced by its lowest and highest point, so no peak or trough is lost;
+* with more than `max_profiles` profiles (default 500), the profile lines start hidden; tick "profiles" to show them.
+
+For example, on a laptop one redraw took 1.2 s with 3000 profiles of 400 points shown, and 0.04 s with them hidden; 200 profiles of 20 000 points took 3.0 s at full resolution and 0.4 s thinned.
+
+The explorer needs `ipywidgets`, and for the smoothest updates the `ipympl` backend:
+
+* running locally (Jupyter or VS Code): `pip install ipywidgets ipympl`, then run `%matplotlib widget` before the cells below;
+* in Colab: run `from google.colab import output` and `output.enable_custom_widget_manager()`, then `%matplotlib widget`.
+
+Without `ipympl` the explorer still works, but redraws the whole figure after each change.
+"""
+
+try:
+    import ipywidgets as widgets
+    from IPython.display import display
+except ImportError:
+    widgets = None
+
+from matplotlib.collections import LineCollection
+
+ALIGNMENT_MODES = ("none", "min_elevation", "min_slope", "max_slope")
+
+
+def thin_segments(x_stack, y_stack, max_points=1000):
+    # (profile, point, x/y) array with at most about max_points points per profile:
+    # each run of neighbouring points is replaced by its lowest and highest point
+    # (in their original order), so peaks and troughs still show at screen resolution
+    n_profiles, n_points = x_stack.shape
+    if n_points <= max_points:
+        return np.stack([x_stack, y_stack], axis=-1)
+    run = int(np.ceil(2 * n_points / max_points))
+    n_runs = int(np.ceil(n_points / run))
+    padding = ((0, 0), (0, n_runs * run - n_points))
+    x_runs = np.pad(x_stack, padding, constant_values=np.nan).reshape(n_profiles, n_runs, run)
+    y_runs = np.pad(y_stack, padding, constant_values=np.nan).reshape(n_profiles, n_runs, run)
+
+    lowest = np.where(np.isnan(y_runs), np.inf, y_runs).argmin(axis=2)
+    highest = np.where(np.isnan(y_runs), -np.inf, y_runs).argmax(axis=2)
+    keep = np.stack([np.minimum(lowest, highest), np.maximum(lowest, highest)], axis=-1)
+    x_thin = np.take_along_axis(x_runs, keep, axis=2).reshape(n_profiles, 2 * n_runs)
+    y_thin = np.take_along_axis(y_runs, keep, axis=2).reshape(n_profiles, 2 * n_runs)
+    return np.stack([x_thin, y_thin], axis=-1)
+
+
+def precompute_alignments(profiles, modes=ALIGNMENT_MODES, min_coverage=1, anchor_stack=None, max_points=1000):
+    # align, resample and aggregate the profiles once for every alignment mode
+    # returns a dictionary of {mode: dictionary of arrays}
+    x_stack, y_stack, lengths = stack_profiles(profiles)
+    results = {}
+    for mode in modes:
+        x_aligned, y_aligned, shifts = align_profiles(x_stack, y_stack, lengths, mode=mode, anchor_stack=anchor_stack)
+        common_x = build_common_grid(x_aligned, min_coverage=min_coverage)
+        interp_y = resample_stack(common_x, x_aligned, y_aligned, lengths)
+        avg_y, std_y, ptp, coverage = stack_statistics(interp_y)
+        results[mode] = {
+            "x": x_aligned, "y": y_aligned, "shifts": shifts, "lengths": lengths,
+            "common_x": common_x, "interp_y": interp_y,
+            "avg_y": avg_y, "std_y": std_y, "ptp": ptp, "coverage": coverage,
+            # thinned (profile, point, x/y) array, ready for a LineCollection
+            "segments": thin_segments(x_aligned, y_aligned, max_points=max_points),
+        }
+    return results
+
+
+def _band_vertices(x, lower, upper):
+    # outline of a fill_between band, as a single polygon
+    return np.concatenate([np.column_stack([x, lower]), np.column_stack([x[::-1], upper[::-1]])])
+
+
+def profile_explorer(alignments, plot_width=12, plot_height=8, max_profiles=500):
+    # interactive plot of the precomputed alignments from precompute_alignments
+    # with more than max_profiles profiles, the profile lines start hidden
+    if widgets is None:
+        raise ImportError("the explorer needs ipywidgets: pip install ipywidgets")
+    live = "ipympl" in mpl.get_backend() or "widget" in mpl.get_backend()
+
+    modes = list(alignments)
+    x_lo = min(a["common_x"][0] for a in alignments.values())
+    x_hi = max(a["common_x"][-1] for a in alignments.values())
+    y_lo = min(np.nanmin(a["y"]) for a in alignments.values())
+    y_hi = max(np.nanmax(a["y"]) for a in alignments.values())
+
+    # create all the artists once; the callbacks only change their data
+    # (without ipympl the figure is shown by the callback, not when it's created)
+    with plt.ioff():
+        fig, ax = plt.subplots(figsize=(plot_width, plot_height))
+    first = alignments[modes[0]]
+    n = len(first["lengths"])
+    profile_lines = LineCollection(first["segments"], colors=plt.cm.plasma(np.linspace(0, 1, n + 2))[:n], linestyles="--", linewidths=2, alpha=0.7)
+    ax.add_collection(profile_lines)
+    mean_line, = ax.plot(first["common_x"], first["avg_y"], color='k', linewidth=2.5, alpha=0.7, label='Mean Profile')
+    ptp_line, = ax.plot(first["common_x"], first["ptp"], color='k', linestyle='--', linewidth=2.5, alpha=0.7, label='Peak to peak profile')
+    std_band = ax.fill_between(first["common_x"], first["avg_y"] - first["std_y"], first["avg_y"] + first["std_y"], color='grey', alpha=0.3)
+    ax.set_xlabel('Distance [m]')
+    ax.set_ylabel('Elevation [m]')
+    handles, labels = ax.get_legend_handles_labels()
+    handles.append(mpatches.Patch(color='grey', label='St. Dev.', alpha=0.3))
+    ax.legend(handles=handles, loc='center left', bbox_to_anchor=(1, 0.5))
+
+    mode_menu = widgets.Dropdown(options=modes, description="Alignment")
+    x_range = widgets.FloatRangeSlider(value=[x_lo, x_hi], min=x_lo, max=x_hi, step=(x_hi - x_lo) / 500,
+                                       description="x range", layout=widgets.Layout(width="600px"))
+    y_range = widgets.FloatRangeSlider(value=[y_lo, y_hi], min=y_lo, max=y_hi, step=(y_hi - y_lo) / 500,
+                                       description="y range", layout=widgets.Layout(width="600px"))
+    show = {name: widgets.Checkbox(value=name != "peak to peak", description=name) for name in ("profiles", "mean", "St. Dev.", "peak to peak")}
+    show["profiles"].value = n <= max_profiles
+    output = widgets.Output()
+
+    def update(change=None):
+        a = alignments[mode_menu.value]
+        # only the part of the stored arrays inside the x range is drawn
+        first_point, last_point = np.searchsorted(a["common_x"], x_range.value)
+        window = slice(first_point, last_point + 1)
+        x = a["common_x"][window]
+
+        # the profile lines only change with the alignment, not with the axis ranges
+        if change is None or change["owner"] is mode_menu:
+            profile_lines.set_segments(a["segments"])
+        mean_line.set_data(x, a["avg_y"][window])
+        ptp_line.set_data(x, a["ptp"][window])
+        std_band.set_verts([_band_vertices(x, a["avg_y"][window] - a["std_y"][window], a["avg_y"][window] + a["std_y"][window])])
+
+        profile_lines.set_visible(show["profiles"].value)
+        mean_line.set_visible(show["mean"].value)
+        std_band.set_visible(show["St. Dev."].value)
+        ptp_line.set_visible(show["peak to peak"].value)
+
+        ax.set_xlim(*x_range.value)
+        ax.set_ylim(*y_range.value)
+        ax.set_title('Topographic Profiles of Profiles, aligned by ' + mode_menu.value.replace("_", " "))
+
+        if live:
+            fig.canvas.draw_idle()
+        else:
+            with output:
+                output.clear_output(wait=True)
+                display(fig)
+
+    for control in [mode_menu, x_range, y_range] + list(show.values()):
+        control.observe(update, names="value")
+
+    update()
+    display(widgets.VBox([mode_menu, x_range, y_range, widgets.HBox(list(show.values())),
+                          fig.canvas if live else output]))
+    return fig
+
+"""Run this cell to create the explorer for the profiles loaded above. Without `ipywidgets` the explorer is skipped, but the alignments are still calculated for the "Summary figure" below."""
+
+alignments = precompute_alignments(profiles, min_coverage=min_coverage)
+if widgets is not None:
+    explorer_figure = profile_explorer(alignments)
+else:
+    print("ipywidgets is not installed - skipping the explorer (pip install ipywidgets)")
+
+"""## Several features at once
+
+If you have profiles across more than one trough or channel, you can load them all together and analyse each feature separately, rather than running the workbook once per feature. Name the files with the feature before `Profile_`, for example `TroughA_Profile_01.txt`, `TroughA_Profile_02.txt`, `TroughB_Profile_01.txt`, ... and `profile_group` will read the group (`"TroughA"`, `"TroughB"`) from each name, in the same way `format_profile_name_2` removes `Profile_`. Files named without a prefix (`Profile_01.txt`) are all put in one group, `"All"`.
+
+`group_statistics` calculates the mean, standard deviation and peak to peak of every group together: the profiles are sorted so each group is a block of rows, and each statistic is summed over all the blocks in one call (`np.add.reduceat`), rather than looping over the groups.
+"""
+
+def profile_group(profile_name, separator="Profile_"):
+    # group of a profile: the part of its name before separator
+    # e.g. "TroughA_Profile_03.txt" -> "TroughA"
+    formatted_name = profile_name.replace(".txt", "")
+    if separator not in formatted_name:
+        return "All"
+    prefix = formatted_name.split(separator)[0].replace("_", " ").strip()
+    return prefix or "All"
+
+
+def group_statistics(interp_y, groups):
+    # mean, standard deviation, peak to peak and coverage of each group of profiles
+    # at each point of the common x axis (see stack_statistics)
+    # returns the sorted group names and one row of each statistic per group
+    names, labels = np.unique(np.asarray(groups), return_inverse=True)
+
+    # sort the profiles so each group is a block of rows starting at starts
+    order = np.argsort(labels, kind='stable')
+    grouped_y = interp_y[order]
+    starts = np.searchsorted(labels[order], np.arange(len(names)))
+
+    valid = ~np.isnan(grouped_y)
+    coverage = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    total = np.add.reduceat(np.where(valid, grouped_y, 0), starts, axis=0, dtype=np.float64)
+    y_max = np.maximum.reduceat(np.where(valid, grouped_y, -np.inf), starts, axis=0)
+    y_min = np.minimum.reduceat(np.where(valid, grouped_y, np.inf), starts, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_y = total / coverage
+
+        # squared deviations from each profile's own group mean
+        deviation = grouped_y.astype(np.float64) - np.repeat(avg_y, np.diff(np.append(starts, len(grouped_y))), axis=0)
+        squares = np.add.reduceat(np.where(valid, deviation ** 2, 0), starts, axis=0)
+        std_y = np.sqrt(squares / coverage)
+
+    ptp = y_max - y_min
+    ptp[coverage == 0] = np.nan
+    return names, avg_y, std_y, ptp, coverage
+
+"""This plot shows the mean and standard deviation of each group, using the alignment chosen in "Choosing the common x axis automatically". Set `group_layout` to `"overlaid"` to draw all the groups on one plot, or `"side_by_side"` for one plot per group."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+group_layout = "side_by_side"  # "side_by_side" or "overlaid"
+
+# Define the height and width of each plot
+plot_height = 6
+plot_width = 8
+
+groups = [profile_group(file_name) for file_name in profiles]
+group_names, group_avg_y, group_std_y, group_ptp, group_coverage = group_statistics(interp_y, groups)
+
+n_groups = len(group_names)
+colors = plt.cm.viridis(np.linspace(0, 1, n_groups + 1))
+
+if group_layout == "overlaid":
+    fig, ax = plt.subplots(figsize=(plot_width, plot_height))
+    axes = [ax] * n_groups
+else:
+    fig, axes = plt.subplots(1, n_groups, sharey=True, squeeze=False, figsize=(plot_width * n_groups, plot_height))
+    axes = axes[0]
+
+for g, (ax, name) in enumerate(zip(axes, group_names)):
+    ax.plot(common_x, group_avg_y[g], color=colors[g], linewidth=2.5, label=name + ' (' + str(groups.count(name)) + ' profiles)')
+    ax.fill_between(common_x, group_avg_y[g] - group_std_y[g], group_avg_y[g] + group_std_y[g], color=colors[g], alpha=0.3)
+    ax.set_xlabel('Distance [m]')
+    if group_layout != "overlaid":
+        ax.set_title(name)
+
+axes[0].set_ylabel('Elevation [m]')
+fig.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Stacked plot for many profiles
+
+The stacked plot in "Other plots" moves each profile up by a fixed `increment = 500` and draws the scale bars up to fixed heights, so it only suits around 20 profiles that are about 500 m deep. `plot_stacked_pages` works for any number of profiles:
+
+* the spacing between profiles (`increment`) and the length of the scale bars are chosen from the data, unless you set them;
+* all the profiles on a page are drawn as one collection of lines, and each kind of marker (maximum elevation, minimum elevation, maximum slope) as one scatter plot, instead of four `plt.plot` calls per profile;
+* the profiles are split into pages of `profiles_per_page`, so each page stays readable. If `file_name` ends in `.pdf`, every page is added to one multi-page PDF and closed straight away, so even 500+ profiles don't use much memory; otherwise the pages are shown one after another.
+"""
+
+from matplotlib.backends.backend_pdf import PdfPages
+
+
+def nice_length(value):
+    # the largest 1, 2 or 5 x 10^n that is no more than value, for scale bars
+    if not np.isfinite(value) or value <= 0:
+        raise ValueError("a scale bar length needs a positive value, not " + str(value))
+    power = 10 ** np.floor(np.log10(value))
+    return power * max(step for step in (1, 2, 5) if step * power <= value)
+
+
+def stacked_increment(y_stack):
+    # spacing between stacked profiles: the median relief of the profiles, or if most
+    # profiles are flat the largest relief, or 1 m if they are all flat
+    relief = np.nanmax(y_stack, axis=1) - np.nanmin(y_stack, axis=1)
+    for increment in (np.median(relief), np.nanmax(relief)):
+        if increment > 0:
+            return increment
+    return 1.0
+
+
+def stacked_markers(x_stack, y_stack, lengths):
+    # x and (unshifted) y of the maximum elevation, minimum elevation and maximum
+    # slope of every profile, as in the stacked plot in "Other plots"
+    rows = np.arange(len(lengths))
+    valid = ~np.isnan(y_stack)
+    y_grad = stack_gradient(x_stack, y_stack, lengths)
+    indices = {
+        "Max. Elevation": np.argmax(np.where(valid, y_stack, -np.inf), axis=1),
+        "Min. Elevation": np.argmin(np.where(valid, y_stack, np.inf), axis=1),
+        "Max. Slope": np.argmax(np.where(valid, y_grad, -np.inf), axis=1),
+    }
+    return {label: (x_stack[rows, index], y_stack[rows, index]) for label, index in indices.items()}
+
+
+def draw_stacked_profiles(ax, names, x_stack, y_stack, lengths, colors, increment, bar_x, bar_y, markers=None):
+    # draw one page of the stacked plot onto ax
+    # every profile is shifted so its lowest point is at 0, then moved up by increment
+    rows = np.arange(len(lengths))
+    floor = np.nanmin(y_stack, axis=1)
+    offsets = rows * increment - floor
+    y_shifted = y_stack + offsets[:, None]
+
+    ax.add_collection(LineCollection(np.stack([x_stack, y_shifted], axis=-1), colors=colors, linestyles="--", linewidths=2, alpha=0.7))
+
+    if markers is None:
+        markers = stacked_markers(x_stack, y_stack, lengths)
+    for (label, (marker_x, marker_y)), marker, size in zip(markers.items(), ["s", "*", "o"], [6, 7, 5]):
+        ax.scatter(marker_x, marker_y + offsets, marker=marker, s=size ** 2, color=colors, label=label, zorder=3)
+
+    # names next to the right hand end of each profile
+    x_end = x_stack[rows, lengths - 1]
+    y_end = y_shifted[rows, lengths - 1]
+    for name, x_text, y_text, color in zip(names, x_end + 0.4 * bar_x, y_end - 0.1 * bar_y, colors):
+        ax.text(x_text, y_text, format_profile_name_2(name), color=color, size="x-small")
+
+    # scale bars of alternating bar_x and bar_y lengths along the bottom and left
+    x_start = np.nanmin(x_stack)
+    x_stop = np.nanmax(x_stack)
+    y_stop = np.nanmax(y_shifted)
+    bottom = np.arange(x_start, x_stop, 2 * bar_x)
+    left = np.arange(0, y_stop, 2 * bar_y)
+    ax.add_collection(LineCollection(
+        [[(x, -bar_y), (x + bar_x, -bar_y)] for x in bottom] +
+        [[(x_start - 2 * bar_x, y), (x_start - 2 * bar_x, y + bar_y)] for y in left],
+        colors="grey", linewidths=10, capstyle="butt"))
+
+    ax.set_xlim(x_start - 3 * bar_x, x_stop + 4 * bar_x)
+    ax.set_ylim(-2 * bar_y, y_stop + bar_y)
+    ax.set(yticks=[], ylabel="Elevation [" + str(round(bar_y)) + " m scalebar]")
+    ax.set(xticks=[], xlabel="Distance [" + str(round(bar_x)) + " m scalebar]")
+    sns.despine(ax=ax, left=True, bottom=True)
+
+
+def plot_stacked_pages(names, x_stack, y_stack, lengths, profiles_per_page=25, increment=None,
+                       bar_x=None, bar_y=None, file_name=None, plot_width=5, plot_height=10):
+    # stacked plot of every profile of a stack from stack_profiles, split into pages
+    # increment, bar_x and bar_y are chosen from the data if they are None
+    if increment is None:
+        increment = stacked_increment(y_stack)
+    if bar_x is None:
+        bar_x = nice_length((np.nanmax(x_stack) - np.nanmin(x_stack)) / 10)
+    if bar_y is None:
+        bar_y = nice_length(increment)
+
+    n = len(lengths)
+    colors = plt.cm.plasma(np.linspace(0, 1, n + 2))[:n]
+    markers = stacked_markers(x_stack, y_stack, lengths)
+
+    # manual legend handles, so they are grey rather than the colour of one profile
+    handles = [Line2D([0], [0], marker=marker, markersize=size, markeredgecolor='grey', markerfacecolor='grey', linestyle='')
+               for marker, size in zip(["s", "*", "o"], [6, 7, 5])]
+
+    pdf = PdfPages(file_name) if file_name is not None and file_name.endswith(".pdf") else None
+    try:
+        for first in range(0, n, profiles_per_page):
+            page = slice(first, first + profiles_per_page)
+            fig, ax = plt.subplots(figsize=(plot_width, plot_height))
+            draw_stacked_profiles(ax, names[page], x_stack[page], y_stack[page], lengths[page], colors[page],
+                                  increment, bar_x, bar_y, {label: (mx[page], my[page]) for label, (mx, my) in markers.items()})
+            ax.legend(handles, markers.keys(), frameon=False, ncol=2, loc='lower center', bbox_to_anchor=(0.5, 1))
+
+            if pdf is not None:
+                pdf.savefig(fig, bbox_inches='tight')
+                plt.close(fig)
+            else:
+                if file_name is not None:
+                    base, extension = os.path.splitext(file_name)
+                    plt.savefig(base + "_" + str(first // profiles_per_page + 1) + extension, dpi=600, bbox_inches='tight')
+                plt.show()
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+"""Set `fig_file_name` to a `.pdf` file name to save every page in one PDF, or to `.png`/`.svg` to save one file per page (`plot01_1.png`, `plot01_2.png`, ...)."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+# using seaborn theme
+sns.set_theme(style="white")
+
+save_figure = False
+
+# Ensure the file name ends in pdf, png or svg (depending on which filetype you want)
+fig_file_name = "stacked_profiles.pdf"
+
+profiles_per_page = 25
+
+# Define the height and width of each page
+plot_height = 10
+plot_width = 5
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+plot_stacked_pages(list(profiles), x_stack, y_stack, lengths, profiles_per_page=profiles_per_page,
+                   file_name=fig_file_name if save_figure else None, plot_width=plot_width, plot_height=plot_height)
+
+"""## Summary figure
+
+This puts the main plots of the workbook side by side in one figure (the "multi-grid plots" mentioned at the end of "Other plots"). Each panel is chosen from:
+
+* `"none"`, `"min_elevation"`, `"min_slope"`, `"max_slope"`: the profiles with that alignment, with their mean and standard deviation;
+* `"ptp"`: the peak to peak profile of every alignment, for comparing how well each one lines the profiles up;
+* `"stacked"`: the stacked plot, as drawn by `plot_stacked_pages`.
+
+The panels are drawn from the alignments calculated once by `precompute_alignments` (see "Interactive explorer"), so the profiles are read, aligned and resampled once for each alignment, however many panels use them.
+"""
+
+SUMMARY_PANELS = ("none", "min_elevation", "max_slope", "ptp", "stacked")
+
+
+def draw_aligned_panel(ax, alignment, colors):
+    # profiles of one alignment from precompute_alignments, with mean and St. Dev.
+    a = alignment
+    ax.add_collection(LineCollection(a["segments"], colors=colors, linestyles="--", linewidths=1, alpha=0.5))
+    ax.plot(a["common_x"], a["avg_y"], color='k', linewidth=2.5, alpha=0.7, label='Mean Profile')
+    ax.fill_between(a["common_x"], a["avg_y"] - a["std_y"], a["avg_y"] + a["std_y"], color='grey', alpha=0.3, label='St. Dev.')
+    ax.set_xlim(a["common_x"][0], a["common_x"][-1])
+    ax.set_ylim(0, np.nanmax(a["y"]))
+    ax.set_xlabel('Distance [m]')
+    ax.set_ylabel('Elevation [m]')
+
+
+def summary_figure(names, alignments, panels=SUMMARY_PANELS, ncols=3, panel_width=6, panel_height=5):
+    # one figure with a panel for each entry of panels (see SUMMARY_PANELS)
+    # alignments is the output of precompute_alignments, and must include every
+    # alignment mode named in panels ("none" is used for the stacked panel)
+    nrows = -(-len(panels) // ncols)
+    fig, axes = plt.subplots(nrows, ncols, squeeze=False, figsize=(panel_width * ncols, panel_height * nrows))
+    axes = axes.ravel()
+
+    n = len(names)
+    colors = plt.cm.plasma(np.linspace(0, 1, n + 2))[:n]
+
+    for ax, panel in zip(axes, panels):
+        if panel == "ptp":
+            for mode, a in alignments.items():
+                ax.plot(a["common_x"], a["ptp"], linewidth=2, label=mode.replace("_", " "))
+            ax.set_xlabel('Distance [m]')
+            ax.set_ylabel('Peak to peak [m]')
+            ax.set_title('Peak to peak profile of each alignment')
+            ax.legend(frameon=False)
+        elif panel == "stacked":
+            a = alignments["none"]
+            increment = stacked_increment(a["y"])
+            bar_x = nice_length((np.nanmax(a["x"]) - np.nanmin(a["x"])) / 10)
+            draw_stacked_profiles(ax, names, a["x"], a["y"], a["lengths"], colors, increment, bar_x, nice_length(increment))
+            ax.set_title('Stacked profiles')
+        else:
+            draw_aligned_panel(ax, alignments[panel], colors)
+            ax.set_title('Aligned by ' + panel.replace("_", " ") if panel != "none" else 'Not aligned')
+
+    # hide any unused panels in the last row
+    for ax in axes[len(panels):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    return fig
+
+"""Choose the panels in `panels`, in the order they should appear (left to right, then top to bottom). This uses the `alignments` calculated for the explorer; if you skipped that cell, uncomment the first line."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+panels = ["none", "min_elevation", "max_slope", "ptp", "stacked"]
+ncols = 3
+
+# Define the height and width of each panel
+panel_height = 5
+panel_width = 6
+
+# alignments = precompute_alignments(profiles, min_coverage=min_coverage)
+summary_figure(list(profiles), alignments, panels=panels, ncols=ncols, panel_width=panel_width, panel_height=panel_height)
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+
+"""## Profiles with longitude and latitude
+
+If your profiles were exported with longitude and latitude (in degrees) rather than distance, the distance along each profile has to be calculated before they can be aligned. Mars is slightly flattened, so the distances are calculated on the Martian ellipsoid (IAU radii: 3396.19 km at the equator, 3376.20 km at the poles) with Vincenty's formula, which is accurate to well under a millimetre.
+
+`geographic_profiles` calculates the length of every step along every profile at once: the profiles are stacked into arrays (as in "Choosing the common x axis automatically"), and each iteration of Vincenty's formula is applied to all the steps together. The result has the same `{file name: (x, y)}` form as the other profiles, with `x` the distance from the first point in metres, so all the sections above can be used with it.
+
+The files should have a header row with `lon`, `lat` and `y` columns (change `columns` below if yours are named differently).
+"""
+
+MARS_EQUATORIAL_RADIUS = 3396190.0  # m
+MARS_POLAR_RADIUS = 3376200.0  # m
+
+
+def vincenty_distance(lon1, lat1, lon2, lat2, a=MARS_EQUATORIAL_RADIUS, b=MARS_POLAR_RADIUS,
+                      tolerance=1e-12, max_iterations=200):
+    # distance [m] along the ellipsoid between points given in degrees
+    # works on arrays of any (matching) shape; NaN inputs give NaN
+    f = (a - b) / a
+    L = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    # iterate all the points together until the longitude on the auxiliary sphere converges
+    lam = L
+    converged = np.isnan(L)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_U2 * sin_lam, cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # on the equator cos2_alpha is 0 and cos_2sigma_m is not needed
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_previous = lam
+            lam = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = converged | (np.abs(lam - lam_previous) <= tolerance)
+            if np.all(converged):
+                break
+        else:
+            # only (nearly) antipodal points fail to converge, which doesn't happen along a profile
+            warnings.warn(str(np.sum(~converged)) + " distances did not converge and are set to NaN")
+
+        u2 = cos2_alpha * (a ** 2 - b ** 2) / b ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+                                                              - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distance = b * A * (sigma - delta_sigma)
+    return np.where(converged, distance, np.nan)
+
+
+def along_track_distance(lon_stack, lat_stack, lengths, **kw):
+    # distance [m] from the first point of each profile, for stacks of longitude and
+    # latitude from stack_profiles (NaN padding is kept)
+    steps = vincenty_distance(lon_stack[:, :-1], lat_stack[:, :-1], lon_stack[:, 1:], lat_stack[:, 1:], **kw)
+    distance = np.zeros(lon_stack.shape)
+    distance[:, 1:] = np.cumsum(np.nan_to_num(steps), axis=1)
+    distance[np.isnan(lon_stack)] = np.nan
+    return distance
+
+
+def geographic_profiles(lonlat_profiles, **kw):
+    # {file name: (lon, lat, y)} -> {file name: (distance along the profile, y)}
+    names = list(lonlat_profiles)
+    lon_stack, lat_stack, lengths = stack_profiles({name: lonlat_profiles[name][:2] for name in names})
+    distance = along_track_distance(lon_stack, lat_stack, lengths, **kw)
+    return {name: (distance[i, :lengths[i]], lonlat_profiles[name][2]) for i, name in enumerate(names)}
+
+"""Read an archive of profiles with longitude and latitude columns (see "Reading profiles from a zip or tar archive"). For files uploaded with `files.upload()`, use `load_profiles(uploaded.items(), columns=columns)` instead. If there is no archive at `geographic_archive_path`, this example is skipped."""
+
+geographic_archive_path = "profiles_lonlat.zip"
+columns = ("lon", "lat", "y")
+
+if os.path.exists(geographic_archive_path):
+    lonlat_profiles = read_profile_archive(geographic_archive_path, columns=columns)
+    geographic = geographic_profiles(lonlat_profiles)
+
+    for file_name, (x, y) in list(geographic.items())[:5]:
+        print(format_profile_name(file_name) + ":", len(x), "points,", round(x[-1] / 1000, 2), "km long")
+
+    # to use these profiles in the sections above, uncomment the next line
+    # profiles = geographic
+else:
+    print("No archive found at", geographic_archive_path, "- skipping this example")
+
+"""## Aligning and resampling in one pass
+
+The plotting cells above take several steps for each profile (`np.gradient`, `np.min`, `np.argmin`/`np.argmax`, `x - x[idx]`, `y - np.min(y)`, then `np.interp`), and each step creates a new array. With thousands of long profiles, most of the time goes into creating and reading those temporary arrays.
+
+`fused_align_resample` does all the steps for one profile in a single loop over its points, and writes the result straight into that profile's row of the output. The loop is compiled with [numba](https://numba.pydata.org) if it is installed (`pip install numba`), and runs on all CPU cores. Without numba, the same result is calculated with the NumPy functions from "Choosing the common x axis automatically", a block of profiles at a time.
+
+The common x axis has to be chosen in advance, for example with `build_common_grid` or `np.linspace(x_min, x_max, num=1000)`.
+"""
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+ALIGNMENT_CODES = {"none": 0, "min_elevation": 1, "min_slope": 2, "max_slope": 3}
+
+
+def _fused_rows(x_stack, y_stack, lengths, code, common_x, tolerance, out, shifts):
+    # gradient, anchor, shifts and interpolation for each profile in one pass
+    # (compiled with numba when it is installed)
+    for i in prange(len(lengths)):
+        n = lengths[i]
+
+        # lowest point and anchor, with the gradient calculated as it is needed
+        y_min = np.inf
+        best = np.inf
+        anchor = 0
+        spacing = x_stack[i, 1] - x_stack[i, 0]
+        for j in range(n):
+            y = y_stack[i, j]
+            if y < y_min:
+                y_min = y
+            if code == 1:
+                value = y
+            elif code >= 2:
+                if j == 0:
+                    value = (y_stack[i, 1] - y) / spacing
+                elif j == n - 1:
+                    value = (y - y_stack[i, j - 1]) / spacing
+                else:
+                    value = (y_stack[i, j + 1] - y_stack[i, j - 1]) / 2 / spacing
+                if code == 3:
+                    value = -value
+            else:
+                continue
+            if value < best:
+                best = value
+                anchor = j
+        shift = x_stack[i, anchor] if code > 0 else 0.0
+        shifts[i] = shift
+
+        # walk along the profile and the common x axis together
+        x_first = x_stack[i, 0] - shift
+        x_last = x_stack[i, n - 1] - shift
+        j = 0
+        for k in range(len(common_x)):
+            xq = common_x[k]
+            if xq < x_first - tolerance or xq > x_last + tolerance:
+                out[i, k] = np.nan
+            elif xq <= x_first:
+                out[i, k] = y_stack[i, 0] - y_min
+            elif xq >= x_last:
+                out[i, k] = y_stack[i, n - 1] - y_min
+            else:
+                while x_stack[i, j + 1] - shift <= xq:
+                    j += 1
+                x0 = x_stack[i, j] - shift
+                slope = (y_stack[i, j + 1] - y_stack[i, j]) / (x_stack[i, j + 1] - shift - x0)
+                out[i, k] = slope * (xq - x0) + y_stack[i, j] - y_min
+
+
+if numba is not None:
+    prange = numba.prange
+    _fused_rows = numba.njit(parallel=True)(_fused_rows)
+else:
+    prange = range
+
+
+def fused_align_resample(x_stack, y_stack, lengths, common_x, mode="min_elevation", out=None, chunk_rows=1024):
+    # align (as align_profiles, with zero_min=True) and resample (as resample_stack)
+    # every profile of a stack from stack_profiles, writing into out if it is given
+    # returns the resampled stack and the x shift of each profile
+    if out is None:
+        out = np.empty((len(lengths), len(common_x)), dtype=y_stack.dtype)
+    shifts = np.empty(len(lengths), dtype=x_stack.dtype)
+    tolerance = 1e-3 * (common_x[1] - common_x[0])
+
+    if numba is not None:
+        _fused_rows(x_stack, y_stack, lengths, ALIGNMENT_CODES[mode], common_x, tolerance, out, shifts)
+    else:
+        # NumPy fallback, a block of rows at a time to limit the size of the temporary arrays
+        for r0 in range(0, len(lengths), chunk_rows):
+            block = slice(r0, r0 + chunk_rows)
+            x_aligned, y_aligned, shifts[block] = align_profiles(x_stack[block], y_stack[block], lengths[block], mode=mode)
+            out[block] = resample_stack(common_x, x_aligned, y_aligned, lengths[block], dtype=out.dtype)
+    return out, shifts
+
+"""This compares the time taken by the original method (one profile at a time, as in the plotting cells above), the NumPy functions and the fused loop, and checks they give the same result. The first call of the fused loop includes compiling it, so it is run once before timing."""
+
+import time
+
+
+def per_profile_align_resample(profiles, common_x, mode="min_elevation"):
+    # the steps of the plotting cells above, one profile at a time
+    interp_y = np.full((len(profiles), len(common_x)), np.nan)
+    for i, (x, y) in enumerate(profiles.values()):
+        spacing = x[1] - x[0]
+        y_grad = np.gradient(y, spacing)
+        if mode == "min_elevation":
+            x_shifted = x - x[np.argmin(y)]
+        elif mode == "min_slope":
+            x_shifted = x - x[np.argmin(y_grad)]
+        elif mode == "max_slope":
+            x_shifted = x - x[np.argmax(y_grad)]
+        else:
+            x_shifted = x
+        y_shifted = y - np.min(y)
+        inside = (common_x >= x_shifted[0]) & (common_x <= x_shifted[-1])
+        interp_y[i, inside] = np.interp(common_x[inside], x_shifted, y_shifted)
+    return interp_y
+
+
+benchmark_mode = "max_slope"
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+benchmark_x = build_common_grid(align_profiles(x_stack, y_stack, lengths, mode=benchmark_mode)[0])
+
+start = time.perf_counter()
+original = per_profile_align_resample(profiles, benchmark_x, mode=benchmark_mode)
+original_time = time.perf_counter() - start
+
+start = time.perf_counter()
+separate_x, separate_y, separate_shifts = align_profiles(x_stack, y_stack, lengths, mode=benchmark_mode)
+separate = resample_stack(benchmark_x, separate_x, separate_y, lengths)
+separate_time = time.perf_counter() - start
+
+fused_align_resample(x_stack, y_stack, lengths, benchmark_x, mode=benchmark_mode)  # compile
+start = time.perf_counter()
+fused, fused_shifts = fused_align_resample(x_stack, y_stack, lengths, benchmark_x, mode=benchmark_mode)
+fused_time = time.perf_counter() - start
+
+print(len(profiles), "profiles,", len(benchmark_x), "points on the common x axis")
+print("One profile at a time:", round(original_time * 1000, 1), "ms")
+print("Stacked NumPy functions:", round(separate_time * 1000, 1), "ms")
+print("Fused" + (" (numba)" if numba is not None else " (NumPy fallback)") + ":", round(fused_time * 1000, 1), "ms")
+print("Largest difference from the original:", np.nanmax(np.abs(fused - original)), "m")
+print("Same points covered:", np.array_equal(np.isnan(fused), np.isnan(separate)))
+
+"""## Checking the profiles for problems
+
+Some problems in exported profiles give wrong plots without any error message:
+
+* `np.interp` assumes `x` increases along the profile: if it is reversed, unsorted or has repeated values, the interpolated profile is wrong;
+* a single NaN (a gap in the DEM) makes `np.min`, `np.mean` and `np.std` return NaN;
+* a file without `x` and `y` columns in its header can't be read at all.
+
+`load_validated_profiles` reads the files like `load_profiles`, then checks every profile at once (the checks are done on the stacked arrays, not one profile at a time). It returns the profiles and a report with one row per profile, in the same form as the table in "Table of measurements for every profile" (so it can be saved with `write_table_csv`). The columns are:
+
+* `x_nan`, `y_nan`: the profile has missing values;
+* `reversed`: `x` decreases along the profile;
+* `unsorted`: `x` neither increases nor decreases along the whole profile;
+* `duplicates`: the profile has repeated `x` values;
+* `repaired`: the profile was fixed, by removing points without an `x` value, sorting by `x`, averaging points with the same `x` and filling gaps in `y` by linear interpolation;
+* `uniform`: after any repairs, the points are evenly spaced.
+
+Files that can't be used (missing columns, fewer than 2 points) are left out, with a warning.
+
+The `uniform` flag tells later steps which profiles can take the fast route. For example, the slope calculation used for aligning (`np.gradient(y, spacing)` with `spacing = x[1] - x[0]`, and `stack_gradient`) is only right for evenly spaced points: `stack_gradient_validated` uses it for the uniform profiles, and a slower calculation that uses the actual `x` of every point (`np.gradient(y, x)`) for the rest. Aligning only shifts each profile, so the flags are still valid after `align_profiles`.
+"""
+
+def check_header(raw_bytes, columns=("x", "y")):
+    # names of the required columns missing from the header row of a profile file
+    names = raw_bytes.split(b'\n', 1)[0].decode(errors='replace').strip().split('\t')
+    return [column for column in columns if column not in names]
+
+
+def validate_stack(x_stack, y_stack, lengths, rtol=1e-6):
+    # check every profile of a stack from stack_profiles at once
+    # returns a dictionary of {check: boolean array with one value per profile}
+    columns = np.arange(x_stack.shape[1])[None, :]
+    inside = columns < lengths[:, None]
+    steps = columns[:, :-1] < lengths[:, None] - 1
+
+    dx = np.diff(x_stack, axis=1)
+    with np.errstate(invalid='ignore'):
+        increasing = np.all(~steps | (dx > 0), axis=1)
+        decreasing = np.all(~steps | (dx <= 0), axis=1)
+        sorted_x = np.all(~steps | (dx >= 0), axis=1)
+        duplicates = np.any(steps & (dx == 0), axis=1)
+        # every step within rtol of the first step
+        uniform = increasing & np.all(~steps | (np.abs(dx - dx[:, :1]) <= rtol * np.abs(dx[:, :1])), axis=1)
+
+    x_nan = np.any(inside & np.isnan(x_stack), axis=1)
+    y_nan = np.any(inside & np.isnan(y_stack), axis=1)
+    return {
+        "x_nan": x_nan,
+        "y_nan": y_nan,
+        "reversed": decreasing & ~x_nan,
+        "unsorted": ~sorted_x & ~decreasing & ~x_nan,
+        "duplicates": duplicates,
+        "uniform": uniform & ~x_nan & ~y_nan,
+    }
+
+
+def repair_profile(x, y):
+    # remove points without x, sort by x, average repeated x values and
+    # fill gaps in y by linear interpolation
+    keep = ~np.isnan(x)
+    x, y = x[keep], y[keep]
+    x_unique, index = np.unique(x, return_inverse=True)
+    if len(x_unique) < len(x) or np.any(np.isnan(y)):
+        has_y = ~np.isnan(y)
+        counts = np.bincount(index, weights=has_y, minlength=len(x_unique))
+        with np.errstate(invalid='ignore'):
+            y_unique = np.bincount(index, weights=np.where(has_y, y, 0), minlength=len(x_unique)) / counts
+        gaps = counts == 0
+        y_unique[gaps] = np.interp(x_unique[gaps], x_unique[~gaps], y_unique[~gaps])
+    else:
+        # no repeats: np.unique has just sorted x
+        y_unique = y[np.argsort(x)]
+    return x_unique.astype(x.dtype), y_unique.astype(y.dtype)
+
+
+def load_validated_profiles(members, max_workers=None, dtype=np.float64, columns=("x", "y"), rtol=1e-6):
+    # load_profiles, plus the checks and repairs described above
+    # returns the profiles and the report
+    members = list(members)
+    usable = []
+    for name, raw in members:
+        missing = check_header(raw, columns)
+        if missing:
+            warnings.warn(name + " is missing the column(s) " + ", ".join(missing) + " and was skipped")
+        else:
+            usable.append((name, raw))
+    profiles = load_profiles(usable, max_workers=max_workers, dtype=dtype, columns=columns)
+
+    for name in [name for name, (x, y) in profiles.items() if np.sum(~np.isnan(x) & ~np.isnan(y)) < 2]:
+        warnings.warn(name + " has fewer than 2 points and was skipped")
+        del profiles[name]
+
+    names = list(profiles)
+    report = validate_stack(*stack_profiles(profiles), rtol=rtol)
+    repaired = report["x_nan"] | report["y_nan"] | report["reversed"] | report["unsorted"] | report["duplicates"]
+    for i in np.flatnonzero(repaired):
+        profiles[names[i]] = repair_profile(*profiles[names[i]])
+
+    # the repaired profiles are checked again, so uniform describes the profiles returned
+    if np.any(repaired):
+        report["uniform"] = validate_stack(*stack_profiles(profiles), rtol=rtol)["uniform"]
+    report["repaired"] = repaired
+    return profiles, {"name": np.asarray(names), **report}
+
+
+def gradient_nonuniform(x_stack, y_stack, lengths):
+    # np.gradient(y, x) of every profile, using the actual x of every point
+    # (slower than stack_gradient, but correct for unevenly spaced points)
+    rows = np.arange(len(lengths))
+    y_grad = np.full(y_stack.shape, np.nan)
+    h_left = x_stack[:, 1:-1] - x_stack[:, :-2]
+    h_right = x_stack[:, 2:] - x_stack[:, 1:-1]
+    y_grad[:, 1:-1] = (h_left ** 2 * y_stack[:, 2:] - h_right ** 2 * y_stack[:, :-2]
+                       + (h_right ** 2 - h_left ** 2) * y_stack[:, 1:-1]) / (h_left * h_right * (h_left + h_right))
+
+    # one-sided differences at both ends of each profile
+    y_grad[:, 0] = (y_stack[:, 1] - y_stack[:, 0]) / (x_stack[:, 1] - x_stack[:, 0])
+    last = lengths - 1
+    y_grad[rows, last] = (y_stack[rows, last] - y_stack[rows, last - 1]) / (x_stack[rows, last] - x_stack[rows, last - 1])
+    return y_grad
+
+
+def stack_gradient_validated(x_stack, y_stack, lengths, uniform):
+    # stack_gradient for the profiles flagged as uniform, gradient_nonuniform for the rest
+    y_grad = stack_gradient(x_stack, y_stack, lengths)
+    uneven = np.flatnonzero(~np.asarray(uniform))
+    if len(uneven):
+        y_grad[uneven] = gradient_nonuniform(x_stack[uneven], y_stack[uneven], lengths[uneven])
+    return y_grad
+
+
+"""Check the same files as `profiles` (the archive at `archive_path`, or the uploaded files if there is no archive; see "Reading profiles from a zip or tar archive"), print the problems found, and align the profiles using the slope calculation that suits each one. Set `report_file_name` to save the report."""
+
+report_file_name = None  # e.g. "validation.csv"
+
+profiles, report = load_validated_profiles(profile_members())
+
+print(len(profiles), "profiles checked")
+for check in ["x_nan", "y_nan", "reversed", "unsorted", "duplicates", "repaired", "uniform"]:
+    print(check + ":", np.sum(report[check]), "profiles", report["name"][report[check]][:5])
+
+if report_file_name is not None:
+    write_table_csv(report, report_file_name)
+
+x_stack, y_stack, lengths = stack_profiles(profiles)
+y_grad = stack_gradient_validated(x_stack, y_stack, lengths, report["uniform"])
+x_aligned, y_aligned, shifts = align_profiles(x_stack, y_stack, lengths, mode=alignment, y_grad=y_grad)
+common_x = build_common_grid(x_aligned, min_coverage=min_coverage)
+interp_y = resample_stack(common_x, x_aligned, y_aligned, lengths)
+avg_y, std_y, ptp, coverage = stack_statistics(interp_y)
+
+"""## Saving the aligned profiles and statistics
+
+The plots are the only output of the cells above, so any further analysis means running the workbook again. `write_stack` saves the numbers behind the plots as [Parquet](https://parquet.apache.org) files (needs `pyarrow`), which can be read by pandas, R, QGIS, DuckDB and most other tools:
+
+* `profiles/part-00000.parquet`, `part-00001.parquet`, ...: one row per profile, with its `name`, its alignment `shift` [m] and its resampled elevations `y` on the common x axis. The rows are written in blocks of `chunk_rows`, so a large stack never has to be converted all at once;
+* `aggregates.parquet`: one row per point of the common x axis, with `x`, `coverage`, `avg_y`, `std_y` and `ptp`, and the running sums they are calculated from (`total`, `squares`, `y_min`, `y_max`).
+
+With `append=True`, new profiles (resampled on the same common x axis) are added as a new part file, and the statistics are updated from the stored running sums, without reading the profiles already saved.
+
+`read_stack` reads the saved profiles; pass `columns=["name", "shift"]` to read only those columns, without loading the elevations. `iter_stack` reads them a block at a time, and `read_aggregates` reads the statistics.
+"""
+
+def _stack_sums(interp_y, chunk_rows=1024):
+    # running sums of a resampled stack: coverage, total, sum of squared
+    # deviations from the mean, minimum and maximum at each point
+    avg_y, std_y, ptp, coverage = stack_statistics(interp_y, chunk_rows=chunk_rows)
+    y_min = np.full(interp_y.shape[1], np.nan)
+    y_max = np.full(interp_y.shape[1], np.nan)
+    for r0 in range(0, len(interp_y), chunk_rows):
+        block = interp_y[r0:r0 + chunk_rows]
+        y_min = np.fmin(y_min, np.fmin.reduce(block, axis=0))
+        y_max = np.fmax(y_max, np.fmax.reduce(block, axis=0))
+    return {
+        "coverage": coverage,
+        "total": np.nan_to_num(avg_y * coverage),
+        "squares": np.nan_to_num(std_y ** 2 * coverage),
+        "y_min": y_min,
+        "y_max": y_max,
+    }
+
+
+def _combine_sums(a, b):
+    # running sums of two stacks together (the squares are combined with
+    # Chan et al.'s formula, so the stacks' own means are not needed)
+    coverage = a["coverage"] + b["coverage"]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = b["total"] / b["coverage"] - a["total"] / a["coverage"]
+        correction = np.nan_to_num(delta ** 2 * a["coverage"] * b["coverage"] / coverage)
+    return {
+        "coverage": coverage,
+        "total": a["total"] + b["total"],
+        "squares": a["squares"] + b["squares"] + correction,
+        "y_min": np.fmin(a["y_min"], b["y_min"]),
+        "y_max": np.fmax(a["y_max"], b["y_max"]),
+    }
+
+
+def _profile_parts(directory):
+    folder = os.path.join(directory, "profiles")
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".parquet"))
+
+
+def write_stack(directory, names, interp_y, shifts, common_x, append=False, chunk_rows=1024):
+    # save a resampled stack (from resample_stack), the shift of each profile
+    # and the statistics, as described above
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to write Parquet files: pip install pyarrow")
+    sums = _stack_sums(interp_y, chunk_rows=chunk_rows)
+    aggregates_file = os.path.join(directory, "aggregates.parquet")
+    parts = _profile_parts(directory)
+
+    if append and os.path.exists(aggregates_file):
+        saved = read_aggregates(directory)
+        if len(saved["x"]) != len(common_x) or not np.allclose(saved["x"], common_x):
+            raise ValueError("the profiles must be resampled on the same common x axis as the saved ones")
+        sums = _combine_sums({key: saved[key] for key in sums}, sums)
+        if parts:
+            # every part must have the same schema to be read together, so the new
+            # elevations are stored with the precision of the saved ones
+            saved_type = pyarrow.parquet.read_schema(parts[0]).field("y").type.value_type
+            interp_y = interp_y.astype(saved_type.to_pandas_dtype(), copy=False)
+    else:
+        for part in parts:
+            os.remove(part)
+        parts = []
+    os.makedirs(os.path.join(directory, "profiles"), exist_ok=True)
+
+    # one new part file, written a block of rows at a time
+    n_points = len(common_x)
+    schema = pyarrow.schema([
+        ("name", pyarrow.string()),
+        ("shift", pyarrow.float64()),
+        ("y", pyarrow.list_(pyarrow.from_numpy_dtype(interp_y.dtype), n_points)),
+    ])
+    part_file = os.path.join(directory, "profiles", "part-" + str(len(parts)).zfill(5) + ".parquet")
+    with pyarrow.parquet.ParquetWriter(part_file, schema) as writer:
+        for r0 in range(0, len(interp_y), chunk_rows):
+            block = np.ascontiguousarray(interp_y[r0:r0 + chunk_rows])
+            writer.write_table(pyarrow.table({
+                "name": pyarrow.array(list(names[r0:r0 + chunk_rows]), pyarrow.string()),
+                "shift": pyarrow.array(np.asarray(shifts[r0:r0 + chunk_rows], dtype=np.float64)),
+                "y": pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(block.ravel()), n_points),
+            }, schema=schema))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        aggregates = {
+            "x": np.asarray(common_x, dtype=np.float64),
+            "coverage": sums["coverage"],
+            "avg_y": sums["total"] / sums["coverage"],
+            "std_y": np.sqrt(sums["squares"] / sums["coverage"]),
+            "ptp": sums["y_max"] - sums["y_min"],
+            **{key: sums[key] for key in ("total", "squares", "y_min", "y_max")},
+        }
+    pyarrow.parquet.write_table(pyarrow.table(aggregates), aggregates_file)
+
+
+def _table_to_columns(table):
+    # pyarrow table -> dictionary of numpy arrays, with "y" as a 2D array
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name).combine_chunks()
+        if name == "y":
+            columns[name] = column.flatten().to_numpy(zero_copy_only=False).reshape(len(column), column.type.list_size)
+        else:
+            columns[name] = column.to_numpy(zero_copy_only=False)
+    return columns
+
+
+def iter_stack(directory, columns=None, batch_size=1024):
+    # yield the saved profiles as dictionaries of columns, batch_size profiles at a time
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to read Parquet files: pip install pyarrow")
+    for part in _profile_parts(directory):
+        for batch in pyarrow.parquet.ParquetFile(part).iter_batches(batch_size=batch_size, columns=columns):
+            yield _table_to_columns(pyarrow.Table.from_batches([batch]))
+
+
+def read_stack(directory, columns=None):
+    # all the saved profiles (or only the given columns) as a dictionary of columns
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to read Parquet files: pip install pyarrow")
+    tables = [pyarrow.parquet.read_table(part, columns=columns) for part in _profile_parts(directory)]
+    return _table_to_columns(pyarrow.concat_tables(tables))
+
+
+def read_aggregates(directory, columns=None):
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to read Parquet files: pip install pyarrow")
+    return _table_to_columns(pyarrow.parquet.read_table(os.path.join(directory, "aggregates.parquet"), columns=columns))
+
+"""Set `save_stack = True` to save the profiles aligned in "Checking the profiles for problems" (or any `interp_y`, `shifts` and `common_x` from the sections above) in `export_directory`. Without `append`, any profiles already saved there are replaced. To add more profiles later, resample them on the same `common_x` and set `append = True`; they are stored with the same precision (float64 or float32) as the profiles already saved."""
+
+save_stack = False
+
+export_directory = "aligned_profiles"
+append = False
+
+if save_stack:
+    write_stack(export_directory, list(profiles), interp_y, shifts, common_x, append=append)
+
+    # read back just the names and shifts, and the statistics
+    saved = read_stack(export_directory, columns=["name", "shift"])
+    saved_aggregates = read_aggregates(export_directory, columns=["x", "coverage", "avg_y", "std_y", "ptp"])
+    print(len(saved["name"]), "profiles saved in", export_directory)
+    for name, shift in list(zip(saved["name"], saved["shift"]))[:5]:
+        print(format_profile_name(name) + ": shifted by", round(shift, 1), "m")
+    print("Largest mean elevation:", round(np.nanmax(saved_aggregates["avg_y"]), 1), "m")
+
+"""## How the profile changes along the feature
+
+For a long trough sampled by many adjacent profiles, the mean of all the profiles hides how the shape changes along it. `sliding_statistics` calculates the mean and standard deviation of every run of `window` neighbouring profiles (profiles 1 to 10, 2 to 11, 3 to 12, ...), so you can see the feature change from one end to the other. The profiles are taken in file name order, so name them in order along the feature (`Profile_001.txt`, `Profile_002.txt`, ...).
+
+Rather than adding up the `window` profiles again for every position, running sums are kept: moving the window along by one profile adds the profile entering the window and subtracts the one leaving it (calculated for all positions at once as differences of cumulative sums). This takes the same time whatever the window size.
+
+The result is shown as a heatmap (distance across the feature against position along it, coloured by the mean elevation) and as a series of mean profiles.
+"""
+
+def sliding_statistics(interp_y, window=10, step=1, chunk_columns=256):
+    # mean, standard deviation and coverage of every `window` neighbouring profiles
+    # of a resampled stack (from resample_stack), for window positions `step` apart
+    # returns the first profile of each window, the window size used (no more than the
+    # number of profiles) and one row of each statistic per window
+    n_profiles, n_points = interp_y.shape
+    window = min(window, n_profiles)
+    starts = np.arange(0, n_profiles - window + 1, step)
+    avg_y = np.empty((len(starts), n_points))
+    std_y = np.empty((len(starts), n_points))
+    coverage = np.empty((len(starts), n_points), dtype=np.int64)
+
+    # a few columns at a time, so the float64 running sums stay small
+    for c0 in range(0, n_points, chunk_columns):
+        block = interp_y[:, c0:c0 + chunk_columns].astype(np.float64)
+        valid = ~np.isnan(block)
+
+        # deviations from each column's overall mean keep the sum of squares accurate
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reference = np.nan_to_num(np.nansum(block, axis=0) / valid.sum(axis=0))
+        deviation = np.where(valid, block - reference, 0)
+
+        # running sums: the sum over profiles i..i+window-1 is cumsum[i + window] - cumsum[i]
+        zero = np.zeros((1, block.shape[1]))
+        counts = np.concatenate([zero, np.cumsum(valid, axis=0)])
+        totals = np.concatenate([zero, np.cumsum(deviation, axis=0)])
+        squares = np.concatenate([zero, np.cumsum(deviation ** 2, axis=0)])
+
+        n = counts[starts + window] - counts[starts]
+        total = totals[starts + window] - totals[starts]
+        square = squares[starts + window] - squares[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_deviation = total / n
+            avg_y[:, c0:c0 + chunk_columns] = reference + mean_deviation
+            variance = np.clip(square / n - mean_deviation ** 2, 0, None)
+            # a single profile has no spread (rather than the rounding error left in variance)
+            std_y[:, c0:c0 + chunk_columns] = np.where(n > 1, np.sqrt(variance), 0)
+        coverage[:, c0:c0 + chunk_columns] = n
+
+    avg_y[coverage == 0] = np.nan
+    std_y[coverage == 0] = np.nan
+    return starts, window, avg_y, std_y, coverage
+
+"""This uses the profiles aligned in "Checking the profiles for problems" (any `interp_y` and `common_x` from the sections above will work). `window` is the number of profiles in each mean (reduced to the number of profiles if there are fewer), and every `profile_step`th mean profile is drawn in the lower plot."""
+
+# reset and themes
+mpl.rc_file_defaults()
+
+save_figure = False
+
+# Ensure the file name ends in png or svg (depending on which filetype you want)
+fig_file_name = "plot01.png"
+
+window = 5        # profiles in each window
+profile_step = 2  # draw every profile_step-th window mean in the lower plot
+
+# Define the height and width of the plot
+plot_height = 10
+plot_width = 12
+
+starts, window, window_avg_y, window_std_y, window_coverage = sliding_statistics(interp_y, window=window)
+names = list(profiles)
+
+fig, (ax_map, ax_profiles) = plt.subplots(2, 1, sharex=True, figsize=(plot_width, plot_height))
+
+# heatmap: one row per window position, labelled by the middle profile of the window
+# (numbered from 1, like the file names)
+middle = starts + (window - 1) / 2 + 1
+mesh = ax_map.pcolormesh(common_x, middle, window_avg_y, cmap='viridis', shading='nearest')
+fig.colorbar(mesh, ax=ax_map, label='Mean elevation [m]')
+ax_map.set_ylabel('Window centre [profile number]')
+ax_map.set_title('Mean of ' + str(window) + ' neighbouring profiles along the feature')
+
+shown = starts[::profile_step]
+colors = plt.cm.plasma(np.linspace(0, 1, len(shown) + 2))
+for color, i in zip(colors, range(0, len(starts), profile_step)):
+    label = format_profile_name(names[starts[i]]) + ' to ' + format_profile_name(names[starts[i] + window - 1])
+    ax_profiles.plot(common_x, window_avg_y[i], color=color, lw=2, alpha=0.8, label=label)
+ax_profiles.set_xlabel('Distance [m]')
+ax_profiles.set_ylabel('Elevation [m]')
+ax_profiles.legend(loc='center left', bbox_to_anchor=(1, 0.5), fontsize='small')
+
+if save_figure:
+    plt.savefig(fig_file_name, dpi=600, bbox_inches='tight')
+plt.show()
+